@@ -2,7 +2,7 @@
 # 
 # MAIN USAGE:
 # 
-# starimage.extract(url_or_html, base_url=None)
+# starimage.extract(url_or_html, base_url=None, **options)
 # 
 #     Params:
 #       url_or_html:
@@ -16,6 +16,146 @@
 #           will automatically be generated from the url but if base_url is set this
 #           will be used first.
 # 
+#     Options: (optional keyword arguments)
+#       max_workers:
+#           maximum number of image probes run at the same time (default 8).
+#       max_per_host:
+#           maximum number of image probes run at the same time against any
+#           one host (default 4). None for no per host limit.
+#       probe_pool:
+#           a starimage.ProbePool to run probes on. Share one pool between
+#           StarImage objects to apply the limits across all of them.
+#       opener:
+#           a urllib2 opener used for the page and image requests, eg
+#           urllib2.build_opener(starimage.ConnectionPool()) to keep connections
+#           open between requests. By default urllib2.urlopen is used.
+#       probe_memo:
+#           a starimage.ProbeMemo to share image probe results with other
+#           StarImage objects.
+#       probe_cache:
+#           a cache of image sizes, either
+#             starimage.MemoryCache(max_entries=100000, ttl=604800) or
+#             starimage.SqliteCache(path, max_entries=100000, ttl=604800)
+#           which keeps its entries in a sqlite file. Entries older than ttl
+#           seconds are revalidated with a conditional HEAD request using the
+#           stored ETag/Last-Modified. cache.stats() returns the hit, miss,
+#           stale, revalidated and eviction counts.
+#       streaming:
+#           if True and url_or_html is a url the page is parsed while it
+#           downloads and each image is probed as soon as its <img /> tag has
+#           been read (default False).
+#       max_stream_bytes:
+#           with streaming, stop reading the page after this many bytes.
+#       max_stream_images:
+#           with streaming, stop reading the page after this many images.
+#       max_page_bytes:
+#           read at most this many bytes of the page, after decompression
+#           (default 8MB). The result of a longer page has 'truncated' True.
+#           None for no limit. Pages are requested with 'Accept-Encoding: gzip,
+#           deflate' and decompressed as they download, and decoded with the
+#           charset of the Content-Type header or of a <meta /> tag.
+#       rank_by:
+#           'size' (default) picks the image with the largest Content-Length.
+#           'area' picks the image with the most pixels. The pixel size is read
+#           from the PNG, GIF, JPEG or WebP header with small Range requests so
+#           images are never downloaded in full. If the header can't be read
+#           the width and height attributes are used. The result then also has
+#           'pixel_width' and 'pixel_height' (None if the header wasn't read).
+#       timeout:
+#           socket timeout in seconds for each page and image request.
+#       deadline:
+#           seconds the whole extract may take. The page fetch and every probe
+#           are cut short to fit, probes not started in time are cancelled and
+#           the largest image found so far is returned with 'complete' False.
+#       stats:
+#           a starimage.ExtractStats(on_phase=None) to record the time spent in
+#           each phase (fetch, parse, xpath, candidates, probe, select, or
+#           stream when streaming) and counts of extracts, bytes downloaded,
+#           probes issued, succeeded, failed, saved, skipped and served from
+#           the probe cache, duplicate urls skipped, size methods, failures
+#           per host, pages served from the page cache and domain profile
+#           predictions and fallbacks. Share one between extracts to add up
+#           their numbers.
+#           stats.as_dict() returns them as a flat dict for a metrics system
+#           and on_phase(phase, seconds) is called as each phase ends. Nothing
+#           is recorded when stats is not set.
+#       use_metadata:
+#           if True the image declared by the page's og:image, twitter:image or
+#           <link rel="image_src" /> (in that order) is returned without
+#           scanning the <img /> tags, once a single probe of it finds a size.
+#           og:image:width and og:image:height give its width and height. With
+#           streaming the page stops downloading at <body>. If nothing usable is
+#           declared every image is probed as usual (default False).
+#       prioritize:
+#           if True images are probed in order of how likely they are to be
+#           the largest: larger width and height attributes first, tracking
+#           pixels, spacers, sprites, icons and .svg files last. Every image is
+#           still probed unless max_probes is set, so the order only matters
+#           when the deadline or max_probes cuts probing short. With streaming
+#           the low priority images wait until the page has been read (default
+#           False).
+#       max_probes:
+#           probe at most this many images, in prioritize order. Setting it
+#           turns prioritize on. With streaming no more than half of them are
+#           probed in page order while the page is read, the rest once it has
+#           been read.
+#       single_flight:
+#           a starimage.SingleFlight. Probes of the same image url that run at
+#           the same time, from any StarImage using the same SingleFlight, make
+#           one request between them and share its size, or its error, as long
+#           as they have the same timeout. Probes whose timeout was cut short by
+#           the deadline don't share. Nothing is kept once the request has
+#           finished, see probe_memo and probe_cache for that. By default
+#           starimage.shared_single_flight is used so every extract in the
+#           process shares it, False turns it off.
+#       host_health:
+#           a starimage.HostHealth(failure_threshold=5, recovery_time=30,
+#           alpha=0.2) that tracks each image host: moving averages of probe
+#           latency and error rate and a circuit breaker. After
+#           failure_threshold failed probes in a row (timeouts, connection
+#           errors and 5xx responses, not 4xx) the circuit opens and images on
+#           the host are given size 0 without a request. After recovery_time
+#           seconds one probe is let through, the circuit closes if it
+#           succeeds. host_health.state(host) returns 'closed', 'open' or
+#           'half-open' and host_health.snapshot() returns the numbers of
+#           every host for a dashboard. Probes that time out because the
+#           deadline is near don't count against a host. Off by default, pass
+#           starimage.shared_host_health to share one across the process.
+#       page_cache:
+#           a cache of whole results for url_or_html urls, keyed by the url and
+#           base_url, either starimage.MemoryCache(max_entries, ttl) or
+#           starimage.SqliteCache(path, max_entries, ttl, table='pages'). A
+#           result younger than ttl seconds is returned without any request.
+#           An older one is revalidated with a conditional GET using the
+#           page's stored ETag/Last-Modified and returned as it is, without
+#           parsing or probing, if the server answers 304 Not Modified. Results
+#           cut short by the deadline, or by an error reading the page, are not
+#           cached. Use one page_cache only for extracts with the same options.
+#       domain_profiles:
+#           a starimage.DomainProfiles(path=None, min_samples=3,
+#           min_confidence=0.8, check_every=10) that learns where the largest
+#           image sits on the pages of each domain: the DOM path of its <img />
+#           tag, eg 'body/div#main/figure.hero/img', and the pattern of its url,
+#           eg 'cdn.example.com/images/*/*.jpg'. Once min_samples pages of a
+#           domain have been extracted and at least min_confidence of them were
+#           won by the same path or pattern, only the images that match are
+#           probed, or with prioritize they are probed first. If none match, or
+#           none of them has a size, every image is probed. Only extracts that
+#           probed every image are learnt from, and every check_every predictions
+#           all the images are probed to check the profile, which is learnt again
+#           from scratch if the winner has moved. Profiles are only used when the
+#           page is read in full, not with streaming. With path set they are
+#           loaded from that json file and profiles.save() writes it.
+#       extended_discovery:
+#           if True images are also found where lazy loading pages put them.
+#           For each <img /> the largest variant in its srcset, or in the
+#           srcset of the <source /> tags of its <picture />, is used (width
+#           descriptors first, then pixel densities), then its data-src,
+#           data-lazy-src or data-original, then its src. Elements with a CSS
+#           background image in their style attribute are candidates too.
+#           Each image is still probed once, with the width and height of the
+#           variant picked (default False).
+# 
 #     Returns:
 #       If no image is found None is returned
 #       otherwise a dictionary object is returned
@@ -24,9 +164,68 @@
 #           'filename': <filename of image (string)>
 #           'size': <size in bytes of image (long)>,
 #           'width': <None or width of image if width attribute set in <img /> tag (int)>,
-#           'height': <None or height of image if height attribute set in <img /> tag (int)>
+#           'height': <None or height of image if height attribute set in <img /> tag (int)>,
+#           'size_method': <how size was found (string or None)>,
+#           'source': <'img', or 'og:image', 'twitter:image' or 'image_src' with use_metadata (string)>,
+#           'probes_saved': <number of images not probed with prioritize (int)>,
+#           'truncated': <True if the page was longer than max_page_bytes (bool)>,
+#           'complete': <False if the deadline passed before all images were probed (bool)>
 #       }
 # 
+#       size_method is 'head' when size came from the Content-Length of a HEAD
+#       request. If the HEAD response had no Content-Length, or the server
+#       rejected HEAD, it is 'range' (Content-Range of a 'Range: bytes=0-0'
+#       GET), 'get' (Content-Length of that GET), 'stream' (the body was
+#       counted) or 'stream-capped' (the body was longer than 256KB, size is
+#       that limit). None if no size was found.
+# 
+# starimage.extract_async(url_or_html, base_url=None, callback=None, **options)
+# 
+#     Runs extract on a shared pool of page threads and returns straight away.
+#     Takes the same params and options as extract. Unless set in options the
+#     page and image requests share starimage.shared_opener, which keeps
+#     connections open across probes and pages, and starimage.shared_probe_pool.
+# 
+#     callback: (optional)
+#         called with the returned future once the extract has finished.
+# 
+#     Returns:
+#       a starimage.Future. future.result(timeout=None) returns the same value
+#       as extract or raises the error extract raised.
+# 
+# starimage.extract_many(urls_or_html, base_url=None, max_pages=32, max_pages_per_host=None, **options)
+# 
+#     Extracts a batch of pages, at most max_pages at the same time and at
+#     most max_pages_per_host at the same time on any one host.
+#     urls_or_html can be any iterable of urls or html strings and is read as
+#     the batch goes so it can be very large. The pages share one connection
+#     pool, one probe pool (max_workers defaults to max_pages * 2) and one
+#     starimage.ProbeMemo so an image used on many pages is only probed once.
+# 
+#     Returns:
+#       a generator of (url_or_html, result) pairs in the order the pages
+#       finish. result is the same value extract returns.
+# 
+# starimage.extract_ranked(url_or_html, k=None, base_url=None, **options)
+# 
+#     Probes every image on the page like extract but yields each one as soon
+#     as its probe finishes, so the first usable image is known before the
+#     slowest probe returns. The page is read in full before probing starts.
+#     Takes the options of extract, except use_metadata, streaming,
+#     page_cache and domain_profiles which are ignored. With prioritize
+#     the images are probed in prioritize order, and only the first
+#     max_probes of them if it is set.
+# 
+#     Returns:
+#       an iterator of starimage.Candidate objects in the order their probes
+#       finish, with url, width, height, index (place on the page), size,
+#       size_method and pixel_width and pixel_height with rank_by='area'.
+#       candidate['url'] works too and candidate.as_dict() returns the same
+#       keys as the result of extract.
+#       iterator.top() returns the k largest candidates yielded so far (all of
+#       them if k is None), largest first. iterator.wait() reads the rest and
+#       returns top(). iterator.close() cancels the probes still running.
+# 
 # Example:
 #   image_details = starimage.extract('http://www.example.com')
 # 
@@ -52,6 +251,31 @@
 # Library dependencies:
 #   lxml: http://lxml.de/
 # 
+# COMMAND LINE:
+# 
+#   python -m starimage [urls_file] [--output FILE] [options]
+# 
+#   Reads urls, one a line, from urls_file or stdin and writes a json line of
+#   {"url": <url>, "result": <result of extract or null>} for each as it
+#   finishes, to FILE or stdout. Blank lines and lines starting with # are
+#   skipped. The urls are shared out over a pool of processes by a hash of
+#   their domain and each process runs extract_many, so pages are parsed in
+#   parallel and their probes run concurrently. FILE is appended to and works
+#   as a checkpoint: a restarted run skips the urls already in it. A summary
+#   of pages done and pages/sec is printed to stderr as the run goes and at
+#   the end. If a process dies the run stops with an error, run it again
+#   with the same FILE to carry on.
+# 
+#   Options:
+#       --processes N         worker processes (default the number of cpus)
+#       --max-pages N         pages in flight in each process (default 32)
+#       --per-domain N        pages in flight on any one domain (default no limit)
+#       --max-per-host N      image probes in flight on any one host in each
+#                             process (default 4)
+#       --timeout S, --deadline S, --rank-by size|area
+#                             the extract options of the same name
+#       --progress-interval S seconds between progress lines (default 10)
+# 
 # Author: Joshua Garner
 
 import logging
@@ -59,17 +283,1136 @@ import urlparse
 import re
 import lxml.html
 import urllib2    
+import httplib
+import socket
 import os
+import sys
+import time
+import threading
+import Queue
+import heapq
+import json
+import sqlite3
+import struct
+import zlib
+import argparse
+import multiprocessing
+from collections import deque, OrderedDict
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_MAX_PAGES = 32
+DEFAULT_CACHE_TTL = 7 * 24 * 60 * 60
+DEFAULT_CACHE_ENTRIES = 100000
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RECOVERY_TIME = 30
+DEFAULT_MAX_PAGE_BYTES = 8 * 1024 * 1024
+STREAM_CHUNK_SIZE = 16 * 1024
+HEADER_BYTES = 1024
+MAX_HEADER_BYTES = 64 * 1024
+MAX_FALLBACK_BYTES = 256 * 1024
+HEAD_UNSUPPORTED_CODES = [400, 403, 405, 501]
+BATCH_POLL_SECONDS = 1
+UNKNOWN_DECLARED_AREA = 100 * 100
+LOW_PRIORITY_URL = re.compile(r'pixel|spacer|blank\.|beacon|tracking|sprite|favicon|/icons?/|\.svg($|\?)', re.I)
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+META_CHARSET_PATTERN = re.compile(r'<meta[^>]+charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+LAZY_SRC_ATTRIBUTES = ['data-src', 'data-lazy-src', 'data-original']
+SRCSET_ATTRIBUTES = ['srcset', 'data-srcset']
+BACKGROUND_IMAGE_PATTERN = re.compile(r'background(?:-image)?\s*:[^;]*?url\(\s*[\'"]?([^\'")]+?)[\'"]?\s*\)', re.I)
+METADATA_NAMES = ['og:image', 'og:image:secure_url', 'og:image:url', 'og:image:width', 'og:image:height',
+                  'twitter:image', 'twitter:image:src']
 
 class HeadRequest(urllib2.Request):
     def get_method(self):
         return "HEAD"
+
+# Returned by StarImage.get_url_content_length, a long that also carries the
+# validators of the response, the method that found the size and any error
+# met while probing, with the HTTP status if the server sent an error.
+# method is one of 'head', 'range', 'get', 'stream', 'stream-capped' or None
+# if no size was found.
+class ContentLength(long):
+
+    def __new__(cls, value=0, etag=None, last_modified=None, not_modified=False, error=None, method=None,
+                status=None):
+        content_length = long.__new__(cls, value)
+        content_length.etag = etag
+        content_length.last_modified = last_modified
+        content_length.not_modified = not_modified
+        content_length.error = error
+        content_length.method = method
+        content_length.status = status
+        return content_length
+
+# Returned by StarImage.get_url_dimensions, a (width, height, size) tuple
+# that also carries any error met while probing, with the HTTP status if the
+# server sent an error, like ContentLength.
+class Dimensions(tuple):
+
+    def __new__(cls, width=None, height=None, size=None, error=None, status=None):
+        dimensions = tuple.__new__(cls, (width, height, size))
+        dimensions.error = error
+        dimensions.status = status
+        return dimensions
+
+# An image found on the page, index is its place among the candidates and
+# path its DOM path when domain profiles are used.
+# size, size_method, pixel_width, pixel_height and value (the size, or the
+# area with rank_by='area') are set once it has been probed. Fields can also
+# be read as candidate['url'].
+class Candidate(object):
+    __slots__ = ['url', 'width', 'height', 'index', 'size', 'size_method', 'pixel_width', 'pixel_height',
+                 'value', 'path']
+
+    def __init__(self, url, width=None, height=None, index=None, path=None):
+        self.url = url
+        self.width = width
+        self.height = height
+        self.index = index
+        self.path = path
+        self.size = None
+        self.size_method = None
+        self.pixel_width = None
+        self.pixel_height = None
+        self.value = None
+
+    def __getitem__(self, name):
+        if name not in Candidate.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __repr__(self):
+        return 'Candidate(%r, size=%r)' % (self.url, self.size)
+
+    # Same keys as the result of extract().
+    def as_dict(self):
+        details = {'url': self.url, 'filename': os.path.basename(self.url), 'size': self.size,
+                   'width': self.width, 'height': self.height, 'size_method': self.size_method}
+        if self.pixel_width is not None or self.pixel_height is not None:
+            details['pixel_width'] = self.pixel_width
+            details['pixel_height'] = self.pixel_height
+        return details
+
+# Iterator over the candidates of StarImage.extract_ranked() in the order
+# their probes finish. top() returns the k largest seen so far, largest
+# first with earlier candidates winning ties.
+class RankedCandidates():
+
+    def __init__(self, candidates, k=None):
+        self.k = k
+        self._candidates = candidates
+        self._heap = []
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        candidate = next(self._candidates)
+        heapq.heappush(self._heap, (candidate.value, -candidate.index, candidate))
+        if self.k is not None and len(self._heap) > self.k:
+            heapq.heappop(self._heap)
+        return candidate
+
+    def top(self):
+        return [candidate for value, index, candidate in sorted(self._heap, reverse=True)]
+
+    # Reads the remaining candidates and returns the top k.
+    def wait(self):
+        for candidate in self:
+            pass
+        return self.top()
+
+    def close(self):
+        self._candidates.close()
+
+class RangeRequest(urllib2.Request):
+    def __init__(self, url, start, end):
+        urllib2.Request.__init__(self, url, headers={'Range': 'bytes=%d-%d' % (start, end)})
+
+class Timeout(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+# Result of work running on a WorkerPool or ProbePool thread.
+class Future():
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = 'pending'
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    @classmethod
+    def completed(cls, result):
+        future = cls()
+        future._result = result
+        future._state = 'finished'
+        return future
+
+    def done(self):
+        return self._state in ['finished', 'cancelled']
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def cancel(self):
+        with self._condition:
+            if self._state != 'pending':
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+            self._condition.notify_all()
+        self.__run_callbacks()
+        return True
+
+    # Called by the worker before running, returns False if cancelled.
+    def set_running_or_notify_cancel(self):
+        with self._condition:
+            if self._state == 'cancelled':
+                return False
+            self._state = 'running'
+            return True
+
+    def set_result(self, result):
+        with self._condition:
+            self._result = result
+            self._state = 'finished'
+            self._condition.notify_all()
+        self.__run_callbacks()
+
+    def set_exception(self, exc_info):
+        with self._condition:
+            self._exc_info = exc_info
+            self._state = 'finished'
+            self._condition.notify_all()
+        self.__run_callbacks()
+
+    def exception(self, timeout=None):
+        self.__wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def result(self, timeout=None):
+        self.__wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, fn):
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def __wait(self, timeout):
+        with self._condition:
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while not self.done():
+                if timeout is None:
+                    self._condition.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise Timeout()
+                    self._condition.wait(remaining)
+            if self._state == 'cancelled':
+                raise Cancelled()
+
+    def __run_callbacks(self):
+        with self._condition:
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                StarImage.handle_exception('Error in future callback: ' + str(e))
+
+# Bounded pool of daemon threads. Threads are started on demand and exit
+# once the queue is empty so a pool needs no shutdown and can be shared.
+class WorkerPool():
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._workers = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            self._queue.append((future, fn, args, kwargs))
+            start_worker = self._workers < self.max_workers
+            if start_worker:
+                self._workers += 1
+        if start_worker:
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+        return future
+
+    def __work(self):
+        while True:
+            with self._lock:
+                if len(self._queue) == 0:
+                    self._workers -= 1
+                    return
+                future, fn, args, kwargs = self._queue.popleft()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except:
+                    future.set_exception(sys.exc_info())
+
+# Runs url probes on a WorkerPool with at most max_workers probes in flight
+# in total and at most max_per_host in flight against any one host.
+class ProbePool():
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST):
+        self.workers = WorkerPool(max_workers)
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._active = {}
+        self._waiting = {}
+
+    def submit(self, url, fn, *args, **kwargs):
+        host = urlparse.urlparse(url).hostname
+        future = Future()
+        item = (future, fn, args, kwargs)
+        with self._lock:
+            active = self._active.get(host, 0)
+            dispatch = self.max_per_host is None or active < self.max_per_host
+            if dispatch:
+                self._active[host] = active + 1
+            else:
+                self._waiting.setdefault(host, deque()).append(item)
+        if dispatch:
+            self.workers.submit(self.__run, host, item)
+        return future
+
+    def __run(self, host, item):
+        future, fn, args, kwargs = item
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except:
+                    future.set_exception(sys.exc_info())
+        finally:
+            self.__release(host)
+
+    def __release(self, host):
+        next_item = None
+        with self._lock:
+            waiting = self._waiting.get(host)
+            if waiting:
+                next_item = waiting.popleft()
+                if len(waiting) == 0:
+                    del self._waiting[host]
+            else:
+                self._active[host] -= 1
+                if self._active[host] == 0:
+                    del self._active[host]
+        if next_item is not None:
+            self.workers.submit(self.__run, host, next_item)
+
+# Shares probe results between StarImage objects, eg across the pages of an
+# extract_many() batch. Probes still in flight are shared as well so a url is
+# only probed once however many pages use it at the same time.
+class ProbeMemo():
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._in_flight = {}
+
+    # submit(url) is called to start the probe if the url is not known yet.
+    # kind keeps apart the results of different probes of the same url.
+    def get(self, url, submit, kind='size'):
+        key = (kind, url)
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                return Future.completed(self._results[key])
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.hits += 1
+                return future
+            self.misses += 1
+            future = submit(url)
+            self._in_flight[key] = future
+        future.add_done_callback(lambda done: self.__store(key, done))
+        return future
+
+    def __store(self, key, future):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._results[key] = future.result()
+            if len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+# Runs one call at a time for each key. Callers asking for a key while its
+# call is running wait for that call and get the same result, or the same
+# exception. Unlike ProbeMemo nothing is kept once the call has finished.
+class SingleFlight():
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+            else:
+                self.calls += 1
+                call = Future()
+                call.set_running_or_notify_cancel()
+                self._in_flight[key] = call
+        if future is not None:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            self.__finish(key)
+            call.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.__finish(key)
+        call.set_result(result)
+        return result
+
+    def __finish(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+# Health of each image host, shared by every StarImage using it: moving
+# averages of probe latency and error rate and a circuit breaker. After
+# failure_threshold failed probes in a row the circuit opens and probes to
+# the host are skipped. Once recovery_time seconds have passed it is
+# half-open and one probe is let through, the circuit closes again if that
+# probe succeeds and reopens if it fails.
+class HostHealth():
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, recovery_time=DEFAULT_RECOVERY_TIME,
+                 alpha=0.2, max_hosts=DEFAULT_CACHE_ENTRIES):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.alpha = alpha
+        self.max_hosts = max_hosts
+        self._lock = threading.Lock()
+        self._hosts = OrderedDict()
+
+    # Returns False if probes to host should be skipped.
+    def allow(self, host):
+        with self._lock:
+            health = self._hosts.get(host)
+            if health is None or health['state'] == 'closed':
+                return True
+            if health['state'] == 'open' and time.time() - health['opened_at'] >= self.recovery_time:
+                health['state'] = 'half-open'
+                return True
+            return False
+
+    def record(self, host, seconds, failed):
+        with self._lock:
+            health = self._hosts.pop(host, None)
+            if health is None:
+                health = {'state': 'closed', 'latency': seconds, 'error_rate': 0.0, 'requests': 0,
+                          'failures': 0, 'consecutive_failures': 0, 'opened_at': None}
+            self._hosts[host] = health
+            if len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+            health['requests'] += 1
+            health['latency'] += self.alpha * (seconds - health['latency'])
+            health['error_rate'] += self.alpha * ((1.0 if failed else 0.0) - health['error_rate'])
+            if failed:
+                health['failures'] += 1
+                health['consecutive_failures'] += 1
+                if health['state'] == 'half-open' or health['consecutive_failures'] >= self.failure_threshold:
+                    health['state'] = 'open'
+                    health['opened_at'] = time.time()
+            else:
+                health['consecutive_failures'] = 0
+                health['state'] = 'closed'
+                health['opened_at'] = None
+
+    # For a probe that says nothing about the host, eg one cut short by the
+    # caller's deadline. A half-open circuit lets the next probe through.
+    def abandon(self, host):
+        with self._lock:
+            health = self._hosts.get(host)
+            if health is not None and health['state'] == 'half-open':
+                health['state'] = 'open'
+
+    def state(self, host):
+        with self._lock:
+            health = self._hosts.get(host)
+            return 'closed' if health is None else health['state']
+
+    # Host to dict of state, latency (seconds), error_rate, requests,
+    # failures, consecutive_failures and opened_at (time or None).
+    def snapshot(self):
+        with self._lock:
+            return dict((host, dict(health)) for host, health in self._hosts.items())
+
+# Learns where the largest image sits on the pages of each domain: the DOM
+# path of its <img /> tag, eg 'body/div#main/figure.hero/img', and the
+# pattern of its url with numbered or hashed parts as *, eg
+# 'cdn.a.com/images/*/*.jpg'. predict() returns the path and pattern that won
+# at least min_confidence of the last extracts of a domain once there have
+# been min_samples of them. Only extracts that probed every image are
+# recorded, check_due() asks for one every check_every predictions so a
+# profile that no longer holds is found out. Profiles are kept in memory and
+# in a json file at path if set, save() writes them.
+class DomainProfiles():
+
+    MAX_SAMPLES = 100
+    MAX_SIGNATURES = 20
+
+    def __init__(self, path=None, min_samples=3, min_confidence=0.8, check_every=10):
+        self.path = path
+        self.min_samples = min_samples
+        self.min_confidence = min_confidence
+        self.check_every = check_every
+        self._lock = threading.Lock()
+        self._profiles = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as profiles_file:
+                self._profiles = json.load(profiles_file)
+
+    def record(self, domain, path, pattern):
+        with self._lock:
+            profile = self._profiles.setdefault(domain, {'samples': 0, 'paths': {}, 'patterns': {}})
+            if profile['samples'] >= DomainProfiles.MAX_SAMPLES:
+                # Older extracts count for less so a redesigned site is learnt again.
+                profile['samples'] = DomainProfiles.__halve(profile)
+            profile['samples'] += 1
+            for counts, signature in [(profile['paths'], path), (profile['patterns'], pattern)]:
+                if signature is not None:
+                    counts[signature] = counts.get(signature, 0) + 1
+                    if len(counts) > DomainProfiles.MAX_SIGNATURES:
+                        del counts[min(counts, key=counts.get)]
+
+    @staticmethod
+    def __halve(profile):
+        for counts in [profile['paths'], profile['patterns']]:
+            for signature in counts.keys():
+                counts[signature] //= 2
+                if counts[signature] == 0:
+                    del counts[signature]
+        return profile['samples'] // 2
+
+    # Returns {'path': ..., 'pattern': ...} with None for a part that isn't
+    # confident, or None if neither is.
+    def predict(self, domain):
+        with self._lock:
+            profile = self._profiles.get(domain)
+            if profile is None or profile['samples'] < self.min_samples:
+                return None
+            prediction = {}
+            for name, counts in [('path', profile['paths']), ('pattern', profile['patterns'])]:
+                prediction[name] = None
+                if len(counts) > 0:
+                    signature = max(counts, key=counts.get)
+                    if counts[signature] >= self.min_confidence * profile['samples']:
+                        prediction[name] = signature
+            if prediction['path'] is None and prediction['pattern'] is None:
+                return None
+            return prediction
+
+    # Counts a prediction for domain and returns True every check_every
+    # predictions, when every image should be probed instead.
+    def check_due(self, domain):
+        with self._lock:
+            profile = self._profiles.get(domain)
+            if profile is None:
+                return False
+            profile['predictions'] = profile.get('predictions', 0) + 1
+            if profile['predictions'] < self.check_every:
+                return False
+            profile['predictions'] = 0
+            return True
+
+    # Drops what was learnt about domain, eg once a check has shown its
+    # prediction to be wrong.
+    def forget(self, domain):
+        with self._lock:
+            self._profiles.pop(domain, None)
+
+    def save(self):
+        if self.path is None:
+            raise ValueError('DomainProfiles has no path to save to')
+        with self._lock:
+            data = json.dumps(self._profiles)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as profiles_file:
+            profiles_file.write(data)
+        os.rename(temp_path, self.path)
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._profiles))
+
+    # Tag names from below the root with the id, or else the first class, of
+    # each element unless it has digits in it.
+    @staticmethod
+    def dom_path(element):
+        parts = []
+        while element is not None and element.getparent() is not None:
+            part = element.tag if isinstance(element.tag, basestring) else ''
+            element_id = (element.get('id') or '').strip()
+            classes = (element.get('class') or '').split()
+            if element_id and not re.search(r'\d', element_id):
+                part += '#' + element_id
+            elif len(classes) > 0 and not re.search(r'\d', classes[0]):
+                part += '.' + classes[0]
+            parts.append(part)
+            element = element.getparent()
+        return '/'.join(reversed(parts))
+
+    @staticmethod
+    def url_pattern(url):
+        parts = urlparse.urlparse(url)
+        segments = parts.path.split('/')
+        pattern = []
+        for index, segment in enumerate(segments):
+            if index == len(segments) - 1:
+                extension = os.path.splitext(segment)[1].lower()
+                pattern.append('*' + extension)
+            elif re.search(r'\d', segment):
+                pattern.append('*')
+            else:
+                pattern.append(segment)
+        return (parts.hostname or '') + '/'.join(pattern)
+
+# Decodes the body of a page as it downloads. gzip and deflate content
+# encodings are decompressed a chunk at a time. feed() returns the next
+# decoded bytes, no more than max_bytes in all, and sets truncated once the
+# page goes over max_bytes so a huge or highly compressed body never has to
+# be held in memory.
+class PageDecoder():
+
+    def __init__(self, content_encoding=None, max_bytes=DEFAULT_MAX_PAGE_BYTES):
+        self.content_encoding = (content_encoding or '').strip().lower()
+        self.max_bytes = max_bytes
+        self.bytes_decoded = 0
+        self.truncated = False
+        self._decompressor = None
+        self._started = False
+        if self.content_encoding in ['gzip', 'x-gzip']:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.content_encoding == 'deflate':
+            self._decompressor = zlib.decompressobj()
+
+    def feed(self, data):
+        if self.truncated:
+            return ''
+        if self._decompressor is not None:
+            data = self.__decompress(data)
+        self._started = True
+        if self.max_bytes is not None and self.bytes_decoded + len(data) > self.max_bytes:
+            data = data[:self.max_bytes - self.bytes_decoded]
+            self.truncated = True
+        self.bytes_decoded += len(data)
+        return data
+
+    # At most one byte more than max_bytes is decompressed, the rest of the
+    # input is left in unconsumed_tail.
+    def __decompress(self, data):
+        limit = 0
+        if self.max_bytes is not None:
+            limit = self.max_bytes - self.bytes_decoded + 1
+        try:
+            return self._decompressor.decompress(data, limit)
+        except zlib.error:
+            # Some servers send deflate without the zlib wrapper.
+            if self.content_encoding != 'deflate' or self._started:
+                raise IOError('Error decompressing page')
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            try:
+                return self._decompressor.decompress(data, limit)
+            except zlib.error:
+                raise IOError('Error decompressing page')
+
+# Reads the pixel size of a PNG, GIF, JPEG or WebP image from the start of
+# the file. feed() is given the bytes of the file from data_offset on and
+# returns True once it is finished, with width and height set if the format
+# was recognised. When it returns False, the bytes from position on are
+# needed. Only a JPEG can need more than the first bytes of the file as the
+# SOF marker holding its size can come after large EXIF segments.
+class ImageHeaderParser():
+
+    JPEG_SOF_MARKERS = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+
+    def __init__(self):
+        self.format = None
+        self.width = None
+        self.height = None
+        self.position = 0
+
+    def feed(self, data, data_offset=0):
+        if self.format is None:
+            if data_offset != 0 or len(data) < 12:
+                return len(data) == 0
+            if data.startswith('\x89PNG\r\n\x1a\n'):
+                self.format = 'png'
+            elif data[:6] in ['GIF87a', 'GIF89a']:
+                self.format = 'gif'
+            elif data.startswith('\xff\xd8'):
+                self.format = 'jpeg'
+                self.position = 2
+            elif data[:4] == 'RIFF' and data[8:12] == 'WEBP':
+                self.format = 'webp'
+            else:
+                self.format = 'unknown'
+                return True
+        if self.format == 'jpeg':
+            return self.__feed_jpeg(data, data_offset)
+        if self.format == 'png' and len(data) >= 24 and data[12:16] == 'IHDR':
+            self.width, self.height = struct.unpack('>II', data[16:24])
+        elif self.format == 'gif' and len(data) >= 10:
+            self.width, self.height = struct.unpack('<HH', data[6:10])
+        elif self.format == 'webp' and len(data) >= 30:
+            self.__feed_webp(data)
+        return True
+
+    def __feed_jpeg(self, data, data_offset):
+        while True:
+            i = self.position - data_offset
+            if i < 0 or i + 4 > len(data):
+                return False
+            if data[i] != '\xff':
+                return True
+            marker = ord(data[i + 1])
+            if marker == 0xff:
+                self.position += 1
+            elif marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                self.position += 2
+            elif marker in [0xd9, 0xda]:
+                return True
+            elif marker in ImageHeaderParser.JPEG_SOF_MARKERS:
+                if i + 9 > len(data):
+                    return False
+                self.height, self.width = struct.unpack('>HH', data[i + 5:i + 9])
+                return True
+            else:
+                self.position += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+
+    def __feed_webp(self, data):
+        chunk = data[12:16]
+        if chunk == 'VP8 ':
+            width, height = struct.unpack('<HH', data[26:30])
+            self.width, self.height = width & 0x3fff, height & 0x3fff
+        elif chunk == 'VP8L':
+            b = [ord(c) for c in data[21:25]]
+            self.width = 1 + (((b[1] & 0x3f) << 8) | b[0])
+            self.height = 1 + (((b[3] & 0xf) << 10) | (b[2] << 2) | ((b[1] & 0xc0) >> 6))
+        elif chunk == 'VP8X':
+            self.width = 1 + struct.unpack('<I', data[24:27] + '\x00')[0]
+            self.height = 1 + struct.unpack('<I', data[27:30] + '\x00')[0]
+
+class PhaseTimer():
+
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.phase, time.time() - self.start)
+
+class NullTimer():
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_TIMER = NullTimer()
+
+# Timings and counters of extract() calls. Pass the same ExtractStats to many
+# StarImage objects to add up their numbers. Phases are 'fetch', 'parse',
+# 'xpath', 'candidates', 'probe' and 'select', or
+# 'stream' for a streaming extract where fetching, parsing and finding
+# candidates overlap. on_phase, if set, is called with the phase name and
+# its seconds each time a phase ends.
+class ExtractStats():
+
+    def __init__(self, on_phase=None):
+        self.on_phase = on_phase
+        self.phase_seconds = {}
+        self.phase_counts = {}
+        self.counters = {'extracts': 0, 'bytes_downloaded': 0, 'probes_issued': 0, 'probes_succeeded': 0,
+                         'probes_failed': 0, 'probes_cached': 0, 'probes_saved': 0, 'probes_skipped': 0,
+                         'pages_cached': 0, 'profile_predictions': 0, 'profile_fallbacks': 0,
+                         'duplicates_skipped': 0}
+        self.size_methods = {}
+        self.host_failures = {}
+        self._lock = threading.Lock()
+
+    def timer(self, phase):
+        return PhaseTimer(self, phase)
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + seconds
+            self.phase_counts[phase] = self.phase_counts.get(phase, 0) + 1
+        if self.on_phase is not None:
+            self.on_phase(phase, seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def probe_finished(self, url, method, error):
+        with self._lock:
+            if error is None:
+                self.counters['probes_succeeded'] += 1
+                self.size_methods[method] = self.size_methods.get(method, 0) + 1
+            else:
+                self.counters['probes_failed'] += 1
+                host = urlparse.urlparse(url).hostname
+                self.host_failures[host] = self.host_failures.get(host, 0) + 1
+
+    # Flat name to number dict, eg {'phase.fetch.seconds': 0.12,
+    # 'probes_issued': 40, 'size_method.head': 38, 'host_failures.a.com': 2}.
+    def as_dict(self):
+        with self._lock:
+            metrics = dict(self.counters)
+            for phase, seconds in self.phase_seconds.items():
+                metrics['phase.' + phase + '.seconds'] = seconds
+                metrics['phase.' + phase + '.count'] = self.phase_counts[phase]
+            for method, count in self.size_methods.items():
+                metrics['size_method.' + str(method)] = count
+            for host, count in self.host_failures.items():
+                metrics['host_failures.' + str(host)] = count
+        return metrics
+
+class CacheEntry():
+
+    def __init__(self, value, stored_at, fresh):
+        self.value = value
+        self.stored_at = stored_at
+        self.fresh = fresh
+
+# Base class for the caches. Entries older than ttl seconds are returned as
+# stale, not dropped, so they can be revalidated. The least recently used
+# entries are evicted once there are more than max_entries.
+class Cache():
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._load(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, stored_at = item
+            fresh = self.ttl is None or time.time() - stored_at < self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return CacheEntry(value, stored_at, fresh)
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, time.time())
+            if self.max_entries is not None:
+                self.evictions += self._evict(self.max_entries)
+
+    # Marks a stale entry as fresh again after a 304 Not Modified.
+    def touch(self, key):
+        with self._lock:
+            self._touch(key, time.time())
+            self.revalidated += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale,
+                'revalidated': self.revalidated, 'evictions': self.evictions}
+
+# In process cache.
+class MemoryCache(Cache):
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        Cache.__init__(self, max_entries, ttl)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self._entries[key] = item
+        return item
+
+    def _store(self, key, value, stored_at):
+        self._entries.pop(key, None)
+        self._entries[key] = (value, stored_at)
+
+    def _touch(self, key, stored_at):
+        if key in self._entries:
+            self._store(key, self._entries[key][0], stored_at)
+
+    def _evict(self, max_entries):
+        evicted = 0
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+# Cache kept in a sqlite file so it survives restarts. Values must be json
+# serializable. Several caches can share one file by using different tables.
+class SqliteCache(Cache):
+
+    def __init__(self, path, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL, table='cache'):
+        Cache.__init__(self, max_entries, ttl)
+        if not re.match('^[A-Za-z_][A-Za-z0-9_]*$', table):
+            raise ValueError('Invalid table name: ' + table)
+        self.table = table
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT, '
+                         'stored_at REAL, used_at REAL)' % table)
+        self._db.execute('CREATE INDEX IF NOT EXISTS %s_used_at ON %s (used_at)' % (table, table))
+        self._db.commit()
+        self._count = self._db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _load(self, key):
+        row = self._db.execute('SELECT value, stored_at FROM %s WHERE key = ?' % self.table, (key,)).fetchone()
+        if row is None:
+            return None
+        self._db.execute('UPDATE %s SET used_at = ? WHERE key = ?' % self.table, (time.time(), key))
+        self._db.commit()
+        return json.loads(row[0]), row[1]
+
+    def _store(self, key, value, stored_at):
+        cursor = self._db.execute('UPDATE %s SET value = ?, stored_at = ?, used_at = ? WHERE key = ?' % self.table,
+                                  (json.dumps(value), stored_at, stored_at, key))
+        if cursor.rowcount == 0:
+            self._db.execute('INSERT INTO %s (key, value, stored_at, used_at) VALUES (?, ?, ?, ?)' % self.table,
+                             (key, json.dumps(value), stored_at, stored_at))
+            self._count += 1
+        self._db.commit()
+
+    def _touch(self, key, stored_at):
+        self._db.execute('UPDATE %s SET stored_at = ?, used_at = ? WHERE key = ?' % self.table,
+                         (stored_at, stored_at, key))
+        self._db.commit()
+
+    def _evict(self, max_entries):
+        excess = self._count - max_entries
+        if excess <= 0:
+            return 0
+        self._db.execute('DELETE FROM %s WHERE key IN (SELECT key FROM %s ORDER BY used_at LIMIT ?)'
+                         % (self.table, self.table), (excess,))
+        self._db.commit()
+        self._count -= excess
+        return excess
+
+# urllib2 handler that keeps http and https connections open and reuses them
+# for later requests to the same host. Use it through urllib2.build_opener().
+# A connection goes back to the pool once its response has been read to the
+# end, HEAD responses go back straight away.
+class ConnectionPool(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+
+    def __init__(self, max_idle_per_host=DEFAULT_MAX_PER_HOST):
+        urllib2.HTTPHandler.__init__(self)
+        urllib2.HTTPSHandler.__init__(self)
+        self.max_idle_per_host = max_idle_per_host
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.do_open(httplib.HTTPSConnection, req)
+
+    http_request = urllib2.AbstractHTTPHandler.do_request_
+    https_request = urllib2.AbstractHTTPHandler.do_request_
+
+    def do_open(self, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (http_class, host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update((name, value) for name, value in req.headers.items() if name not in headers)
+        headers = dict((name.title(), value) for name, value in headers.items())
+        # A reused connection may have been closed by the server while idle,
+        # in which case the request is retried once on a new connection.
+        while True:
+            connection, reused = self.__get_connection(key, req.timeout)
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.data, headers)
+                response = connection.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if not reused:
+                    raise urllib2.URLError(e)
+            else:
+                break
+        pooled = PooledResponse(self, key, connection, response)
+        if response.length == 0:
+            pooled.recv(0)
+        resp = urllib2.addinfourl(socket._fileobject(pooled, close=True), response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def idle_count(self):
+        with self._lock:
+            return sum(len(connections) for connections in self._idle.values())
+
+    def __get_connection(self, key, timeout):
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+        http_class, host = key
+        if http_class is httplib.HTTPSConnection:
+            return http_class(host, timeout=timeout, context=self._context), False
+        return http_class(host, timeout=timeout), False
+
+# Socket-like wrapper handed to socket._fileobject by ConnectionPool. It gives
+# the connection back to the pool once the response has been read to the end.
+class PooledResponse():
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+
+    def recv(self, amt):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.__release()
+        return data
+
+    def close(self):
+        if self.connection is not None and not self.response.isclosed():
+            self.connection.close()
+            self.connection = None
+        self.__release()
+
+    def __release(self):
+        if self.connection is not None:
+            connection = self.connection
+            self.connection = None
+            if self.response.will_close:
+                connection.close()
+            else:
+                self.pool.release(self.key, connection)
         
 class StarImage():
     
-    def __init__(self, url_or_html, base_url=None):
+    def __init__(self, url_or_html, base_url=None, max_workers=DEFAULT_MAX_WORKERS,
+                 max_per_host=DEFAULT_MAX_PER_HOST, probe_pool=None, opener=None, probe_memo=None,
+                 probe_cache=None, streaming=False, max_stream_bytes=None, max_stream_images=None,
+                 rank_by='size', timeout=None, deadline=None, stats=None, use_metadata=False,
+                 prioritize=False, max_probes=None, single_flight=None, host_health=None, page_cache=None,
+                 max_page_bytes=DEFAULT_MAX_PAGE_BYTES, domain_profiles=None, extended_discovery=False):
         self.url_or_html = url_or_html
         self.base_url = base_url
+        if probe_pool is None:
+            probe_pool = ProbePool(max_workers, max_per_host)
+        self.probe_pool = probe_pool
+        self.max_workers = max(1, max_workers)
+        self.opener = opener
+        self.probe_memo = probe_memo
+        self.probe_cache = probe_cache
+        self.streaming = streaming
+        self.max_stream_bytes = max_stream_bytes
+        self.max_stream_images = max_stream_images
+        if rank_by not in ['size', 'area']:
+            raise ValueError('rank_by must be size or area: ' + str(rank_by))
+        self.rank_by = rank_by
+        self.timeout = timeout
+        self.deadline = deadline
+        self.complete = True
+        self.__deadline_at = None
+        self.stats = stats
+        self.use_metadata = use_metadata
+        self.prioritize = prioritize or max_probes is not None
+        self.max_probes = max_probes
+        self.probes_saved = 0
+        if single_flight is None:
+            single_flight = shared_single_flight
+        self.single_flight = single_flight or None
+        self.host_health = host_health
+        self.page_cache = page_cache
+        self.max_page_bytes = max_page_bytes
+        self.truncated = False
+        self.domain_profiles = domain_profiles
+        self.extended_discovery = extended_discovery
+        self.__predicted = set()
+        self.__checked_prediction = None
+        self.__page_entry = None
+        self.__page_validators = None
+        self.__page_not_modified = False
+        self.__base_href = None
         
     @staticmethod 
     def is_url(url):
@@ -97,21 +1440,155 @@ class StarImage():
             except ValueError:
                 return False 
                 
+    # Opens with urllib2.urlopen unless an opener, eg one built with a
+    # ConnectionPool, is given. timeout is the socket timeout in seconds.
+    @staticmethod
+    def open_url(request, opener=None, timeout=None):
+        if opener is None:
+            if timeout is None:
+                return urllib2.urlopen(request)
+            return urllib2.urlopen(request, timeout=timeout)
+        if timeout is None:
+            return opener.open(request)
+        return opener.open(request, timeout=timeout)
+
+    # With etag or last_modified set the HEAD request is conditional and a
+    # 304 Not Modified is returned as ContentLength(0, not_modified=True).
+    # If the HEAD response has no Content-Length, or the server rejects HEAD,
+    # and fallback is set the size is read from the Content-Range of a
+    # 'Range: bytes=0-0' GET. Failing that the body is read and counted,
+    # stopping after max_fallback_bytes bytes.
     @staticmethod            
-    def get_url_content_length(url):
-        content_length = 0
+    def get_url_content_length(url, opener=None, etag=None, last_modified=None, fallback=True,
+                               max_fallback_bytes=MAX_FALLBACK_BYTES, timeout=None):
+        request = HeadRequest(url)
+        if etag is not None:
+            request.add_header('If-None-Match', etag)
+        if last_modified is not None:
+            request.add_header('If-Modified-Since', last_modified)
         try:
-            response = urllib2.urlopen(HeadRequest(url))
+            response = StarImage.open_url(request, opener, timeout)
         except urllib2.URLError, e:
+            code = getattr(e, 'code', None)
+            if code == 304:
+                return ContentLength(0, etag, last_modified, not_modified=True)
             if hasattr(e, 'reason'):
-                StarImage.handle_exception('We failed to read a server for: ' + url + '. Reason: ' + str(e.reason))
-            elif hasattr(e, 'code'):
-                StarImage.handle_exception('The server couldn\'t fulfill the request for: ' + url + '. Error code: ' + str(e.code))
+                message = 'We failed to read a server for: ' + url + '. Reason: ' + str(e.reason)
+            else:
+                message = 'The server couldn\'t fulfill the request for: ' + url + '. Error code: ' + str(e.code)
+            if not fallback or code not in HEAD_UNSUPPORTED_CODES:
+                StarImage.handle_exception(message)
+                return ContentLength(0, error=message, status=code)
+        except (httplib.HTTPException, socket.error), e:
+            message = 'Error reading size for: ' + url + '. Reason: ' + str(e)
+            StarImage.handle_exception(message)
+            return ContentLength(0, error=message)
         else:
             if response.headers.has_key('content-length'):
-                content_length = long(response.headers['content-length'])
-        return content_length                           
-    
+                return ContentLength(long(response.headers['content-length']), response.headers.get('etag'),
+                                     response.headers.get('last-modified'), method='head')
+            if not fallback:
+                return ContentLength(0, response.headers.get('etag'), response.headers.get('last-modified'))
+        return StarImage.__get_content_length_from_get(url, opener, max_fallback_bytes, timeout)
+
+    @staticmethod
+    def __get_content_length_from_get(url, opener, max_fallback_bytes, timeout):
+        try:
+            response = StarImage.open_url(RangeRequest(url, 0, 0), opener, timeout)
+            try:
+                headers = response.headers
+                if response.getcode() == 206:
+                    total = StarImage.get_content_range_total(headers.get('content-range'))
+                    response.read()
+                    if total is not None:
+                        return ContentLength(total, headers.get('etag'), headers.get('last-modified'), method='range')
+                elif StarImage.is_number(headers.get('content-length')):
+                    return ContentLength(long(headers.get('content-length')), headers.get('etag'),
+                                         headers.get('last-modified'), method='get')
+                else:
+                    return StarImage.__count_content_length(response, max_fallback_bytes)
+            finally:
+                response.close()
+            response = StarImage.open_url(url, opener, timeout)
+            try:
+                return StarImage.__count_content_length(response, max_fallback_bytes)
+            finally:
+                response.close()
+        except urllib2.URLError, e:
+            message = 'Error reading size for: ' + url + '. Reason: ' + str(getattr(e, 'reason', e))
+        except (httplib.HTTPException, socket.error), e:
+            message = 'Error reading size for: ' + url + '. Reason: ' + str(e)
+        StarImage.handle_exception(message)
+        return ContentLength(0, error=message)
+
+    @staticmethod
+    def __count_content_length(response, max_bytes):
+        headers = response.headers
+        count = 0
+        while count <= max_bytes:
+            chunk = response.read(min(STREAM_CHUNK_SIZE, max_bytes + 1 - count))
+            if not chunk:
+                return ContentLength(count, headers.get('etag'), headers.get('last-modified'), method='stream')
+            count += len(chunk)
+        return ContentLength(max_bytes, headers.get('etag'), headers.get('last-modified'), method='stream-capped')
+
+    # Reads the pixel size of an image from the start of the file with Range
+    # requests of header_bytes bytes, never reading past max_header_bytes.
+    # If the server ignores Range the response is read only as far as the
+    # header and then closed. Returns Dimensions(width, height, size) where
+    # size is the full size of the file from Content-Range or Content-Length.
+    # Any of them can be None.
+    @staticmethod
+    def get_url_dimensions(url, opener=None, header_bytes=HEADER_BYTES, max_header_bytes=MAX_HEADER_BYTES,
+                           timeout=None):
+        parser = ImageHeaderParser()
+        size = None
+        start = 0
+        try:
+            while True:
+                response = StarImage.open_url(RangeRequest(url, start, start + header_bytes - 1), opener, timeout)
+                try:
+                    if response.getcode() == 206:
+                        if size is None:
+                            size = StarImage.get_content_range_total(response.headers.get('content-range'))
+                        data = response.read(header_bytes)
+                        done = parser.feed(data, start) or len(data) < header_bytes
+                    else:
+                        if size is None and StarImage.is_number(response.headers.get('content-length')):
+                            size = long(response.headers.get('content-length'))
+                        data = ''
+                        done = False
+                        while not done and len(data) < max_header_bytes:
+                            chunk = response.read(min(header_bytes, max_header_bytes - len(data)))
+                            if not chunk:
+                                break
+                            data += chunk
+                            done = parser.feed(data)
+                        done = True
+                finally:
+                    response.close()
+                if done or parser.position + header_bytes > max_header_bytes:
+                    break
+                start = parser.position
+        except urllib2.URLError, e:
+            message = 'Error reading image header for: ' + url + '. Reason: ' + str(getattr(e, 'reason', e))
+            StarImage.handle_exception(message)
+            return Dimensions(parser.width, parser.height, size, error=message, status=getattr(e, 'code', None))
+        except (httplib.HTTPException, socket.error), e:
+            message = 'Error reading image header for: ' + url + '. Reason: ' + str(e)
+            StarImage.handle_exception(message)
+            return Dimensions(parser.width, parser.height, size, error=message)
+        return Dimensions(parser.width, parser.height, size)
+
+    # Total size from a Content-Range header eg 'bytes 0-1023/45678'.
+    @staticmethod
+    def get_content_range_total(content_range):
+        if content_range is not None:
+            match = re.search('/(\d+)\s*$', content_range)
+            if match is not None:
+                return long(match.group(1))
+        return None
+
     @classmethod
     def handle_exception(cls, message):
          logging.error('starimage: ' + message)   
@@ -119,10 +1596,122 @@ class StarImage():
     def __get_doc_from_url(self):
         doc = None
         try:
-            doc = lxml.html.fromstring(urllib2.urlopen(self.url_or_html).read())  
+            with self.__timer('fetch'):
+                response = self.__open_page()
+                if response is None:
+                    return None
+                html = self.__read_page(response)
+            with self.__timer('parse'):
+                encoding = StarImage.get_page_encoding(StarImage.__response_headers(response), html)
+                if encoding is None:
+                    doc = lxml.html.fromstring(html)
+                else:
+                    doc = lxml.html.fromstring(html, parser=lxml.html.HTMLParser(encoding=encoding))
         except IOError:
+            # A page that failed partway through isn't cached.
+            self.__page_validators = None
             StarImage.handle_exception('Error opening url: ' + self.url_or_html)
         return doc
+
+    # Opens the page, with a conditional GET if its result is in the
+    # page_cache. Returns None if the server answers 304 Not Modified.
+    def __open_page(self):
+        request = urllib2.Request(self.url_or_html, headers={'Accept-Encoding': 'gzip, deflate'})
+        entry = self.__page_entry
+        if entry is not None:
+            if entry.value.get('etag'):
+                request.add_header('If-None-Match', entry.value['etag'])
+            if entry.value.get('last_modified'):
+                request.add_header('If-Modified-Since', entry.value['last_modified'])
+        try:
+            response = StarImage.open_url(request, self.opener, self.__request_timeout())
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry is not None:
+                self.__page_not_modified = True
+                return None
+            raise
+        headers = StarImage.__response_headers(response)
+        self.__page_validators = (headers.get('etag'), headers.get('last-modified'))
+        return response
+
+    @staticmethod
+    def __response_headers(response):
+        return getattr(response, 'headers', None) or {}
+
+    # The charset label of the Content-Type header, or failing that of a
+    # <meta /> tag near the start of html. None if neither names an encoding
+    # the lxml parser knows, libxml2 then works the encoding out itself.
+    # Labels are passed on as they are as libxml2 doesn't know Python codec
+    # names such as euc_jp.
+    @staticmethod
+    def get_page_encoding(headers, html=''):
+        match = CHARSET_PATTERN.search(headers.get('content-type') or '')
+        if match is None:
+            match = META_CHARSET_PATTERN.search(html[:HEADER_BYTES * 4])
+        if match is None:
+            return None
+        try:
+            lxml.html.HTMLParser(encoding=match.group(1))
+        except LookupError:
+            return None
+        return match.group(1)
+
+    def __page_decoder(self, response):
+        return PageDecoder(StarImage.__response_headers(response).get('content-encoding'), self.max_page_bytes)
+
+    # Reads the page in chunks so the deadline is checked as it downloads.
+    # What has been read so far is returned if the deadline passes, or the
+    # first max_page_bytes bytes with truncated set if the page is longer.
+    def __read_page(self, response):
+        chunks = []
+        decoder = self.__page_decoder(response)
+        bytes_read = 0
+        try:
+            while not decoder.truncated:
+                if self.__deadline_passed():
+                    self.complete = False
+                    break
+                chunk = response.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                bytes_read += len(chunk)
+                chunks.append(decoder.feed(chunk))
+        finally:
+            response.close()
+            self.truncated = decoder.truncated
+            if self.stats is not None:
+                self.stats.increment('bytes_downloaded', bytes_read)
+        return ''.join(chunks)
+
+    # Times a phase when stats are on, does nothing otherwise.
+    def __timer(self, phase):
+        if self.stats is None:
+            return NULL_TIMER
+        return self.stats.timer(phase)
+
+    def __start_deadline(self):
+        self.complete = True
+        if self.deadline is not None:
+            self.__deadline_at = time.time() + self.deadline
+
+    # Seconds left before the deadline, None if there is no deadline.
+    def __remaining(self):
+        if self.__deadline_at is None:
+            return None
+        return max(self.__deadline_at - time.time(), 0)
+
+    def __deadline_passed(self):
+        return self.__deadline_at is not None and time.time() >= self.__deadline_at
+
+    # Socket timeout for the next request, cut short by the deadline.
+    def __request_timeout(self):
+        remaining = self.__remaining()
+        if remaining is None:
+            return self.timeout
+        remaining = max(remaining, 0.001)
+        if self.timeout is None:
+            return remaining
+        return min(self.timeout, remaining)
         
     def __get_doc(self):
         doc = None
@@ -134,74 +1723,1024 @@ class StarImage():
                 doc = self.__get_doc_from_url()
                 from_url = True
             elif StarImage.is_html(self.url_or_html):
-                doc = lxml.html.document_fromstring(self.url_or_html)
+                with self.__timer('parse'):
+                    doc = lxml.html.document_fromstring(self.url_or_html)
             else:
-                doc = lxml.html.fragment_fromstring(self.url_or_html)
+                with self.__timer('parse'):
+                    doc = lxml.html.fragment_fromstring(self.url_or_html)
         except lxml.etree.ParserError, e:
             StarImage.handle_exception('Error parsing HTML')
         else:    
             if doc is not None:
                 if self.base_url is None and from_url == True:            
-                    parts = urlparse.urlparse(self.url_or_html)
-                    if parts.scheme in ['http', 'https'] and parts.hostname is not None:
-                        self.base_url = parts.scheme + '://' + parts.hostname
+                    self.__set_base_url_from_url()
+                # Only image urls are resolved, see __resolve_src, so the
+                # document is left as it is.
                 if self.base_url is not None:
-                    doc.make_links_absolute(self.base_url)        
+                    base_hrefs = doc.xpath('//base/@href')
+                    if len(base_hrefs) > 0 and base_hrefs[-1]:
+                        self.__base_href = base_hrefs[-1]
         return doc                                     
+
+    def __set_base_url_from_url(self):
+        parts = urlparse.urlparse(self.url_or_html)
+        if parts.scheme in ['http', 'https'] and parts.hostname is not None:
+            self.base_url = parts.scheme + '://' + parts.hostname
            
     def __get_images(self, doc):
         if doc is None:
             return None
         else:
-            return doc.xpath('//img')    
+            with self.__timer('xpath'):
+                if self.extended_discovery:
+                    return [element for element in doc.xpath('//img|//*[@style]') if self.__is_image(element)]
+                return doc.xpath('//img')    
 
     def __get_image_details(self, images):
         image_details = []
         if images is not None:
-            for image in images:            
-                src = image.get('src')
-                if StarImage.is_url(src):
-                    url_already_used = False
-                    for image_item in image_details:
-                        if image_item['url'] == src:
-                            url_already_used = True
-                            break
-                    if not url_already_used:
-                        image_detail = {'url': src, 'width': None, 'height': None}
-                        image_width = image.get('width')
-                        image_height = image.get('height')
-                        if StarImage.is_number(image_width):
-                            image_detail['width'] = int(image_width)
-                        if StarImage.is_number(image_height):
-                            image_detail['height'] = int(image_height)
+            with self.__timer('candidates'):
+                seen = set()
+                for image in images:            
+                    src, declared = self.__image_source(image)
+                    src = self.__resolve_src(src, self.__base_href)
+                    image_detail = self.__get_image_detail(image, src, seen, declared)
+                    if image_detail is not None:
                         image_details.append(image_detail)
         return image_details        
 
+    # Returns None if src is not an absolute url or is in seen, the set of
+    # urls already used. declared is the (width, height) of src if it isn't
+    # given by the width and height attributes.
+    def __get_image_detail(self, image, src, seen, declared=None):
+        if StarImage.is_url(src):
+            if src in seen:
+                if self.stats is not None:
+                    self.stats.increment('duplicates_skipped')
+                return None
+            seen.add(src)
+            path = None
+            if self.domain_profiles is not None:
+                path = DomainProfiles.dom_path(image)
+            if declared is None:
+                declared = (StarImage.__declared_size(image.get('width')),
+                            StarImage.__declared_size(image.get('height')))
+            return Candidate(src, declared[0], declared[1], len(seen) - 1, path)
+        return None
+
+    # An <img /> tag, or with extended_discovery an element with a CSS
+    # background image in its style attribute.
+    def __is_image(self, element):
+        if element.tag == 'img':
+            return True
+        return self.extended_discovery and BACKGROUND_IMAGE_PATTERN.search(element.get('style') or '') is not None
+
+    # Returns the src of the one image an element stands for and its
+    # declared (width, height), or None to use the width and height
+    # attributes. With extended_discovery the largest variant in the
+    # srcset of the <img /> or of the <source /> tags of its <picture /> is
+    # used, then its lazy load attributes, then its src. Other elements give
+    # their CSS background image.
+    def __image_source(self, element):
+        if not self.extended_discovery:
+            return element.get('src'), None
+        if element.tag != 'img':
+            return BACKGROUND_IMAGE_PATTERN.search(element.get('style')).group(1), None
+        sources = [element]
+        parent = element.getparent()
+        if parent is not None and parent.tag == 'picture':
+            sources = [source for source in parent if source.tag == 'source'] + sources
+        variants = []
+        for source in sources:
+            for name in SRCSET_ATTRIBUTES:
+                variants.extend(StarImage.parse_srcset(source.get(name)))
+        if len(variants) > 0:
+            return self.__largest_variant(element, variants)
+        for name in LAZY_SRC_ATTRIBUTES:
+            src = (element.get(name) or '').strip()
+            if src and not src.startswith('data:'):
+                return src, None
+        return element.get('src'), None
+
+    # Width descriptors are preferred to densities as they give the real width.
+    def __largest_variant(self, element, variants):
+        widths = [variant for variant in variants if variant[1] == 'w']
+        if len(widths) > 0:
+            url, kind, value = max(widths, key=lambda variant: variant[2])
+        else:
+            url, kind, value = max(variants, key=lambda variant: variant[2])
+        width = StarImage.__declared_size(element.get('width'))
+        height = StarImage.__declared_size(element.get('height'))
+        if kind == 'w':
+            if width and height:
+                height = int(round(height * value / float(width)))
+            else:
+                height = None
+            width = int(value)
+        else:
+            width = int(round(width * value)) if width is not None else None
+            height = int(round(height * value)) if height is not None else None
+        return url, (width, height)
+
+    # Returns the (url, kind, value) of each image candidate in a srcset,
+    # kind 'w' for a width descriptor and 'x' for a pixel density.
+    @staticmethod
+    def parse_srcset(srcset):
+        variants = []
+        remaining = srcset or ''
+        while True:
+            remaining = remaining.lstrip(' \t\n\r\f,')
+            if not remaining:
+                return variants
+            url = re.match(r'\S+', remaining).group(0)
+            remaining = remaining[len(url):]
+            descriptors = ''
+            if url.endswith(','):
+                url = url.rstrip(',')
+            else:
+                descriptors, comma, remaining = remaining.partition(',')
+            kind, value = 'x', 1.0
+            for descriptor in descriptors.split():
+                if descriptor[-1:] in ['w', 'x'] and StarImage.is_number(descriptor[:-1]):
+                    kind, value = descriptor[-1], float(descriptor[:-1])
+            if not url.startswith('data:'):
+                variants.append((url, kind, value))
+
+    @staticmethod
+    def __declared_size(value):
+        if StarImage.is_number(value):
+            return int(value)
+        return None
+
+    # Reads the page in chunks through an incremental parser. Each <img> is
+    # probed as soon as its tag has been parsed so probing overlaps the
+    # download. Reading stops early after max_stream_bytes bytes or
+    # max_stream_images images.
+    def __extract_streaming(self):
+        try:
+            response = self.__open_page()
+        except IOError:
+            StarImage.handle_exception('Error opening url: ' + self.url_or_html)
+            return None
+        if response is None:
+            return None
+        if self.base_url is None:
+            self.__set_base_url_from_url()
+        decoder = self.__page_decoder(response)
+        encoding = StarImage.get_page_encoding(StarImage.__response_headers(response))
+        if encoding is None:
+            parser = lxml.etree.HTMLPullParser(events=('start',))
+        else:
+            parser = lxml.etree.HTMLPullParser(events=('start',), encoding=encoding)
+        base_href = None
+        metadata = [] if self.use_metadata else None
+        image_details = []
+        seen = set()
+        futures = []
+        scheduled = {}
+        bytes_read = 0
+        try:
+            with self.__timer('stream'):
+                while not decoder.truncated and not self.__stream_limit_reached(bytes_read, len(image_details)):
+                    if self.__deadline_passed():
+                        self.complete = False
+                        break
+                    chunk = response.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    bytes_read += len(chunk)
+                    parser.feed(decoder.feed(chunk))
+                    for event, element in parser.read_events():
+                        if element.tag == 'base' and element.get('href'):
+                            base_href = element.get('href')
+                        elif metadata is not None and element.tag in ['meta', 'link']:
+                            metadata.append(element)
+                        elif metadata is not None and element.tag in ['body', 'img']:
+                            # The <head> has been read, stop if it declares a usable image.
+                            details = self.__get_metadata_image(metadata, base_href)
+                            if details is not None:
+                                return details
+                            metadata = None
+                        if self.__is_image(element) and not self.__stream_limit_reached(bytes_read, len(image_details)):
+                            src, declared = self.__image_source(element)
+                            src = self.__resolve_src(src, base_href)
+                            image_detail = self.__get_image_detail(element, src, seen, declared)
+                            if image_detail is not None:
+                                image_details.append(image_detail)
+                                if not self.prioritize:
+                                    futures.append(self.__submit_probe(image_detail.url))
+                                elif self.__probe_priority(image_detail, 0)[0] <= 0 and \
+                                        (self.max_probes is None or len(scheduled) < self.max_probes // 2):
+                                    # Low priority images wait until the page has been read, and
+                                    # so does half of max_probes for the images found later.
+                                    scheduled[len(image_details) - 1] = self.__submit_probe(image_detail.url)
+        except IOError:
+            self.__page_validators = None
+            StarImage.handle_exception('Error reading url: ' + self.url_or_html)
+        finally:
+            response.close()
+            self.truncated = decoder.truncated
+            if self.stats is not None:
+                self.stats.increment('bytes_downloaded', bytes_read)
+        with self.__timer('probe'):
+            if self.prioritize:
+                sizes = self.__probe_prioritized(image_details, scheduled)
+            else:
+                sizes = self.__wait_for_probes(futures)
+        with self.__timer('select'):
+            return self.__select_largest(image_details, sizes)
+
+    def __stream_limit_reached(self, bytes_read, image_count):
+        if self.max_stream_bytes is not None and bytes_read >= self.max_stream_bytes:
+            return True
+        return self.max_stream_images is not None and image_count >= self.max_stream_images
+
+    # Resolves src against base_url the same way make_links_absolute would,
+    # honouring the document's <base href>.
+    def __resolve_src(self, src, base_href=None):
+        if src is None or self.base_url is None:
+            return src
+        src = src.strip()
+        if base_href is not None:
+            src = urlparse.urljoin(base_href, src)
+        return urlparse.urljoin(self.base_url, src)
+
+    # Returns the image declared by og:image, twitter:image or
+    # <link rel="image_src" /> in that order, with og:image:width and
+    # og:image:height if set. Only the first declaration is probed, None is
+    # returned if there is none or its probe finds no size.
+    def __get_metadata_image(self, elements, base_href=None):
+        declarations = self.__get_metadata_declarations(elements)
+        if len(declarations) == 0:
+            return None
+        source, src, width, height = declarations[0]
+        url = self.__resolve_src(src, base_href)
+        if not StarImage.is_url(url):
+            return None
+        image_detail = Candidate(url, StarImage.__declared_size(width), StarImage.__declared_size(height), 0)
+        with self.__timer('probe'):
+            probed = self.__wait_for_probes([self.__submit_probe(url)])[0]
+        if probed is None or getattr(probed, 'error', None) is not None:
+            return None
+        if self.rank_by == 'area':
+            if probed[0] is None and probed[2] is None:
+                return None
+        elif probed <= 0:
+            return None
+        details = self.__select_largest([image_detail], [probed])
+        details['source'] = source
+        return details
+
+    def __get_metadata_declarations(self, elements):
+        declared = {}
+        for element in elements:
+            if element.tag == 'meta':
+                name = (element.get('property') or element.get('name') or '').strip().lower()
+                content = element.get('content')
+                if name in METADATA_NAMES and content and name not in declared:
+                    declared[name] = content.strip()
+            elif element.tag == 'link':
+                rel = (element.get('rel') or '').lower().split()
+                if 'image_src' in rel and element.get('href') and 'image_src' not in declared:
+                    declared['image_src'] = element.get('href').strip()
+        declarations = []
+        for name in ['og:image', 'og:image:secure_url', 'og:image:url']:
+            if name in declared:
+                declarations.append(('og:image', declared[name], declared.get('og:image:width'),
+                                     declared.get('og:image:height')))
+                break
+        for name in ['twitter:image', 'twitter:image:src']:
+            if name in declared:
+                declarations.append(('twitter:image', declared[name], None, None))
+                break
+        if 'image_src' in declared:
+            declarations.append(('image_src', declared['image_src'], None, None))
+        return declarations
+
+    # Probes run concurrently but sizes come back in candidate order.
+    def __probe_sizes(self, image_details):
+        futures = [self.__submit_probe(image_detail.url) for image_detail in image_details]
+        return self.__wait_for_probes(futures)
+
+    # Probes the candidates most likely to be the largest first, no more than
+    # max_workers at a time and max_probes in all. futures are probes already
+    # submitted by candidate index. Sizes come back in candidate order, None
+    # if not probed.
+    def __probe_prioritized(self, image_details, futures=None):
+        futures = dict(futures or {})
+        sizes = [None] * len(image_details)
+        finished = Queue.Queue()
+        for index, future in futures.items():
+            future.add_done_callback(lambda future, index=index: finished.put(index))
+        order = sorted(range(len(image_details)), key=lambda i: self.__probe_priority(image_details[i], i))
+        pending = deque(index for index in order if index not in futures)
+        running = len(futures)
+        while True:
+            while len(pending) > 0 and running < self.max_workers and \
+                    (self.max_probes is None or len(futures) < self.max_probes):
+                index = pending.popleft()
+                future = self.__submit_probe(image_details[index].url)
+                futures[index] = future
+                running += 1
+                future.add_done_callback(lambda future, index=index: finished.put(index))
+            if running == 0:
+                break
+            try:
+                index = finished.get(True, self.__remaining())
+            except Queue.Empty:
+                self.complete = False
+                break
+            running -= 1
+            try:
+                sizes[index] = futures[index].result(0)
+            except (Timeout, Cancelled):
+                continue
+            except Exception, e:
+                StarImage.handle_exception('Error probing: ' + image_details[index].url + '. Reason: ' + str(e))
+        if not self.complete and self.probe_memo is None:
+            for future in futures.values():
+                future.cancel()
+        self.probes_saved = len(image_details) - len(futures)
+        if self.stats is not None:
+            self.stats.increment('probes_saved', self.probes_saved)
+        return sizes
+
+    # Lower sorts first: images predicted by the domain profile go first and
+    # low priority urls and tiny images last, then larger declared areas
+    # first and DOM order breaks ties.
+    def __probe_priority(self, image_detail, index):
+        if image_detail.index in self.__predicted:
+            return (-1, 0, index)
+        width, height = image_detail.width, image_detail.height
+        low_priority = LOW_PRIORITY_URL.search(image_detail.url) is not None
+        if width is not None and height is not None:
+            low_priority = low_priority or width <= 2 or height <= 2
+            area = width * height
+        else:
+            area = UNKNOWN_DECLARED_AREA
+        return (1 if low_priority else 0, -area, index)
+
+    def __probe_value(self, image_detail, probed):
+        if self.rank_by != 'area':
+            return probed
+        width, height = probed[0], probed[1]
+        if width is None or height is None:
+            width, height = image_detail.width, image_detail.height
+        return width * height if width is not None and height is not None else 0
+
+    # Waits until the deadline at most. Probes not finished by then have a
+    # size of None and the ones not started yet are cancelled, unless they
+    # are shared with other pages through a ProbeMemo.
+    def __wait_for_probes(self, futures):
+        sizes = []
+        for future in futures:
+            try:
+                sizes.append(future.result(self.__remaining()))
+            except (Timeout, Cancelled):
+                sizes.append(None)
+                self.complete = False
+            except Exception, e:
+                # A probe that raised has no size, it doesn't stop the others.
+                StarImage.handle_exception('Error probing: ' + str(e))
+                sizes.append(None)
+        if not self.complete and self.probe_memo is None:
+            for future in futures:
+                future.cancel()
+        return sizes
+
+    def __submit_probe(self, url):
+        if self.probe_memo is not None:
+            return self.probe_memo.get(url, self.__submit_network_probe, self.rank_by)
+        return self.__submit_network_probe(url)
+
+    def __submit_network_probe(self, url):
+        if self.rank_by == 'area':
+            return self.__submit_dimensions_probe(url)
+        entry = None
+        if self.probe_cache is not None:
+            entry = self.probe_cache.get(url)
+            if entry is not None and entry.fresh:
+                if self.stats is not None:
+                    self.stats.increment('probes_cached')
+                return Future.completed(StarImage.__cached_content_length(entry))
+        return self.probe_pool.submit(url, self.__probe_url, url, entry)
+
+    # A stale cache entry is revalidated with its etag and last_modified.
+    def __probe_url(self, url, entry=None):
+        if not self.__host_allowed(url):
+            return ContentLength(0, error='Circuit open for host: ' + urlparse.urlparse(url).hostname)
+        if self.stats is not None:
+            self.stats.increment('probes_issued')
+        if entry is None:
+            size = self.__call_once(('size', url), StarImage.__probe_failed, StarImage.get_url_content_length,
+                                    url, opener=self.opener, timeout=self.__request_timeout())
+        else:
+            etag, last_modified = entry.value.get('etag'), entry.value.get('last_modified')
+            size = self.__call_once(('size', url, etag, last_modified), StarImage.__probe_failed,
+                                    StarImage.get_url_content_length, url, opener=self.opener, etag=etag,
+                                    last_modified=last_modified, timeout=self.__request_timeout())
+            if getattr(size, 'not_modified', False):
+                self.probe_cache.touch(url)
+                size = StarImage.__cached_content_length(entry)
+                self.__record_probe(url, size)
+                return size
+        self.__record_probe(url, size)
+        self.__cache_probe(url, size)
+        return size
+
+    # Concurrent probes of the same key, from any StarImage sharing the
+    # single_flight, make one request between them. Only probes with the same
+    # timeout share, and a probe whose timeout was cut short to fit the
+    # deadline runs on its own so its timeout is never passed on to others.
+    def __call_once(self, key, failed, fn, url, *args, **kwargs):
+        if self.single_flight is None or kwargs.get('timeout') != self.timeout:
+            return self.__call_tracked(failed, fn, url, *args, **kwargs)
+        return self.single_flight.do(key + (self.timeout,), self.__call_tracked, failed, fn, url, *args, **kwargs)
+
+    # Records the latency of the probe with host_health and whether
+    # failed(result) says it failed. A probe that failed once its timeout,
+    # cut short to fit the deadline, had run out didn't measure the image, so
+    # the result isn't complete, and it isn't held against the host.
+    def __call_tracked(self, failed, fn, url, *args, **kwargs):
+        timeout = kwargs.get('timeout')
+        started = time.time()
+        probe_failed = True
+        try:
+            result = fn(url, *args, **kwargs)
+            probe_failed = failed(result)
+        finally:
+            seconds = time.time() - started
+            cut_short = probe_failed and timeout is not None and timeout != self.timeout and seconds >= timeout
+            if cut_short:
+                self.complete = False
+            if self.host_health is not None:
+                host = urlparse.urlparse(url).hostname
+                if cut_short:
+                    self.host_health.abandon(host)
+                else:
+                    self.host_health.record(host, seconds, probe_failed)
+        return result
+
+    def __host_allowed(self, url):
+        if self.host_health is None or self.host_health.allow(urlparse.urlparse(url).hostname):
+            return True
+        if self.stats is not None:
+            self.stats.increment('probes_skipped')
+        return False
+
+    # Whether a ContentLength or Dimensions probe failed. Errors the server
+    # answered with a 4xx status say nothing about the health of the host.
+    @staticmethod
+    def __probe_failed(probed):
+        error = getattr(probed, 'error', None)
+        status = getattr(probed, 'status', None)
+        return error is not None and (status is None or status >= 500)
+
+    def __record_probe(self, url, size):
+        if self.stats is not None:
+            method = getattr(size, 'method', None)
+            if method in ['stream', 'stream-capped']:
+                self.stats.increment('bytes_downloaded', long(size))
+            self.stats.probe_finished(url, method, getattr(size, 'error', None))
+
+    @staticmethod
+    def __cached_content_length(entry):
+        value = entry.value
+        return ContentLength(value['size'], value.get('etag'), value.get('last_modified'), method=value.get('method'))
+
+    # Dimensions are cached under their own key and are not revalidated.
+    def __submit_dimensions_probe(self, url):
+        if self.probe_cache is not None:
+            entry = self.probe_cache.get('dimensions:' + url)
+            if entry is not None and entry.fresh:
+                if self.stats is not None:
+                    self.stats.increment('probes_cached')
+                return Future.completed(tuple(entry.value))
+        return self.probe_pool.submit(url, self.__probe_dimensions, url)
+
+    def __probe_dimensions(self, url):
+        if not self.__host_allowed(url):
+            return Dimensions(error='Circuit open for host: ' + urlparse.urlparse(url).hostname)
+        dimensions = self.__call_once(('dimensions', url), StarImage.__probe_failed, StarImage.get_url_dimensions,
+                                      url, opener=self.opener, timeout=self.__request_timeout())
+        if self.stats is not None:
+            self.stats.increment('probes_issued')
+            error = 'no dimensions' if dimensions[:2] == (None, None) else None
+            self.stats.probe_finished(url, 'range', error)
+        if self.probe_cache is not None and dimensions != (None, None, None):
+            self.probe_cache.set('dimensions:' + url, list(dimensions))
+        return dimensions
+
+    def __cache_probe(self, url, size):
+        if self.probe_cache is not None and getattr(size, 'error', None) is None:
+            self.probe_cache.set(url, {'size': long(size), 'etag': getattr(size, 'etag', None),
+                                       'last_modified': getattr(size, 'last_modified', None),
+                                       'method': getattr(size, 'method', None)})
+
     def __get_largest_image(self, images): 
-        largest_details = None   
         image_details = self.__get_image_details(images)
+        details = self.__probe_predicted(image_details)
+        if details is None:
+            with self.__timer('probe'):
+                if self.prioritize:
+                    sizes = self.__probe_prioritized(image_details)
+                else:
+                    sizes = self.__probe_sizes(image_details)
+            with self.__timer('select'):
+                details = self.__select_largest(image_details, sizes)
+            self.__learn_winner(image_details, details)
+        return details
+
+    # With a confident domain profile only the candidates it predicts are
+    # probed, or with prioritize they are probed first. Returns None to fall
+    # back to probing every candidate, as when no candidate matches the
+    # profile, none of them has a size or the profile is due a check.
+    def __probe_predicted(self, image_details):
+        self.__predicted = set()
+        self.__checked_prediction = None
+        domain = self.__profile_domain()
+        if domain is None:
+            return None
+        prediction = self.domain_profiles.predict(domain)
+        if prediction is None:
+            return None
+        if self.domain_profiles.check_due(domain):
+            self.__checked_prediction = prediction
+            return None
+        predicted = [image_detail for image_detail in image_details
+                     if StarImage.__matches_prediction(image_detail, prediction)]
+        if len(predicted) == 0:
+            if self.stats is not None:
+                self.stats.increment('profile_fallbacks')
+            return None
+        if self.prioritize:
+            self.__predicted = set(image_detail.index for image_detail in predicted)
+            return None
+        with self.__timer('probe'):
+            sizes = self.__probe_sizes(predicted)
+        with self.__timer('select'):
+            details = self.__select_largest(predicted, sizes)
+        if not self.__has_size(details):
+            if self.stats is not None:
+                self.stats.increment('profile_fallbacks')
+            return None
+        if self.stats is not None:
+            self.stats.increment('profile_predictions')
+        self.probes_saved = len(image_details) - len(predicted)
+        return details
+
+    # With rank_by='area' an image has a size if its width and height are
+    # known, from its header or its attributes.
+    def __has_size(self, details):
+        if details is None:
+            return False
+        if self.rank_by != 'area':
+            return bool(details['size'])
+        if details['pixel_width'] is not None and details['pixel_height'] is not None:
+            return True
+        return details['width'] is not None and details['height'] is not None
+
+    @staticmethod
+    def __matches_prediction(image_detail, prediction):
+        return image_detail.path == prediction['path'] or \
+            DomainProfiles.url_pattern(image_detail.url) == prediction['pattern']
+
+    # Only a winner out of every image is learnt, one found by probing just
+    # the predicted images would only ever confirm the profile. A check that
+    # finds the winner elsewhere drops the profile so it is learnt again.
+    def __learn_winner(self, image_details, details):
+        domain = self.__profile_domain()
+        if domain is None or details is None or not self.complete or self.probes_saved > 0:
+            return
+        for image_detail in image_details:
+            if image_detail.url == details['url']:
+                prediction = self.__checked_prediction
+                if prediction is not None and not StarImage.__matches_prediction(image_detail, prediction):
+                    self.domain_profiles.forget(domain)
+                self.domain_profiles.record(domain, image_detail.path, DomainProfiles.url_pattern(image_detail.url))
+                return
+
+    # The host of the page url, or of base_url for html.
+    def __profile_domain(self):
+        if self.domain_profiles is None:
+            return None
+        if StarImage.is_url(self.url_or_html):
+            return page_host(self.url_or_html)
+        return page_host(self.base_url)
+
+    # Earliest candidate wins ties so the result is the same however the probes were scheduled.
+    def __select_largest(self, image_details, sizes):
+        if self.rank_by == 'area':
+            return self.__select_largest_area(image_details, sizes)
+        largest_details = None   
         if len(image_details) > 0:
-            for image_detail in image_details:
-                content_length = StarImage.get_url_content_length(image_detail['url'])  
+            for image_detail, content_length in zip(image_details, sizes):
+                if content_length is None:
+                    continue
                 if largest_details is None:
                     largest_details = {'url': None, 'size': None}
                 if largest_details['size'] is None or content_length > largest_details['size']:
-                    largest_details['url'] = image_detail['url']
+                    largest_details['url'] = image_detail.url
                     largest_details['size'] = content_length
-                    largest_details['width'] = image_detail['width']
-                    largest_details['height'] = image_detail['height']
+                    largest_details['width'] = image_detail.width
+                    largest_details['height'] = image_detail.height
+                    largest_details['size_method'] = getattr(content_length, 'method', None)
         if largest_details is not None:
             largest_details['filename'] = os.path.basename(largest_details['url'])
         return largest_details  
 
+    # Ranks by pixel area read from the image headers. If a header could not
+    # be read the width and height attributes of the <img /> tag are used.
+    def __select_largest_area(self, image_details, dimensions):
+        largest_details = None
+        largest_area = None
+        for image_detail, probed in zip(image_details, dimensions):
+            if probed is None:
+                continue
+            pixel_width, pixel_height, size = probed
+            width, height = pixel_width, pixel_height
+            if width is None or height is None:
+                width, height = image_detail.width, image_detail.height
+            area = width * height if width is not None and height is not None else 0
+            if largest_area is None or area > largest_area:
+                largest_area = area
+                largest_details = {'url': image_detail.url, 'size': size or 0,
+                                   'width': image_detail.width, 'height': image_detail.height,
+                                   'pixel_width': pixel_width, 'pixel_height': pixel_height}
+        if largest_details is not None:
+            largest_details['filename'] = os.path.basename(largest_details['url'])
+        return largest_details
+
+    # The result has 'complete' set to False if the deadline passed before
+    # every image was probed, it is then the largest image found in time.
     def extract(self):
+        self.__start_deadline()
+        self.truncated = False
+        if self.stats is not None:
+            self.stats.increment('extracts')
+        page_key = self.__page_key()
+        if page_key is not None:
+            self.__page_entry = self.page_cache.get(page_key)
+            self.__page_validators = None
+            self.__page_not_modified = False
+            if self.__page_entry is not None and self.__page_entry.fresh:
+                return self.__cached_page_result()
+        if self.streaming and StarImage.is_url(self.url_or_html):
+            details = self.__extract_streaming()
+        else:
+            details = self.__extract_doc()
+        if self.__page_not_modified:
+            self.page_cache.touch(page_key)
+            return self.__cached_page_result()
+        if details is not None:
+            details.setdefault('source', 'img')
+            details['probes_saved'] = self.probes_saved
+            details['truncated'] = self.truncated
+            details['complete'] = self.complete
+        if page_key is not None and self.__page_validators is not None and self.complete:
+            etag, last_modified = self.__page_validators
+            self.page_cache.set(page_key, {'result': details, 'etag': etag, 'last_modified': last_modified})
+        return details
+
+    # Results are cached by page url and the base_url given.
+    def __page_key(self):
+        if self.page_cache is None or not StarImage.is_url(self.url_or_html):
+            return None
+        return self.url_or_html + ' ' + (self.base_url or '')
+
+    def __cached_page_result(self):
+        if self.stats is not None:
+            self.stats.increment('pages_cached')
+        result = self.__page_entry.value['result']
+        if result is None:
+            return None
+        return dict(result)
+
+    def __extract_doc(self):
         doc = self.__get_doc()
         if doc is None:
             return None
         else:
+            if self.use_metadata:
+                details = self.__get_metadata_image(doc.xpath('//meta|//link'), self.__base_href)
+                if details is not None:
+                    return details
             images = self.__get_images(doc)
             return self.__get_largest_image(images)
+
+    # Returns a RankedCandidates of the images on the page, each yielded with
+    # its size as soon as its probe finishes. The page is read in full
+    # before probing starts. Probes still running when the iterator is
+    # closed are cancelled. With prioritize the candidates are submitted in
+    # priority order, and no more than max_probes of them.
+    def extract_ranked(self, k=None):
+        return RankedCandidates(self.__probe_ranked(), k)
+
+    def __probe_ranked(self):
+        self.__start_deadline()
+        if self.stats is not None:
+            self.stats.increment('extracts')
+        doc = self.__get_doc()
+        if doc is None:
+            return
+        candidates = self.__get_image_details(self.__get_images(doc))
+        if self.prioritize:
+            order = sorted(range(len(candidates)), key=lambda i: self.__probe_priority(candidates[i], i))
+            candidates = [candidates[i] for i in order[:self.max_probes]]
+        finished = Queue.Queue()
+        futures = []
+        for candidate in candidates:
+            future = self.__submit_probe(candidate.url)
+            future.add_done_callback(lambda future, candidate=candidate: finished.put((candidate, future)))
+            futures.append(future)
+        try:
+            for i in range(len(candidates)):
+                try:
+                    candidate, future = finished.get(True, self.__remaining())
+                except Queue.Empty:
+                    self.complete = False
+                    break
+                try:
+                    probed = future.result(0)
+                except (Timeout, Cancelled):
+                    self.complete = False
+                    continue
+                except Exception, e:
+                    StarImage.handle_exception('Error probing: ' + candidate.url + '. Reason: ' + str(e))
+                    continue
+                self.__set_probed(candidate, probed)
+                yield candidate
+        finally:
+            if self.probe_memo is None:
+                for future in futures:
+                    future.cancel()
+
+    def __set_probed(self, candidate, probed):
+        candidate.value = self.__probe_value(candidate, probed)
+        if self.rank_by == 'area':
+            candidate.pixel_width, candidate.pixel_height, candidate.size = probed
+            candidate.size = candidate.size or 0
+        else:
+            candidate.size = probed
+            candidate.size_method = getattr(probed, 'method', None)
+
+    # Runs extract() on page_pool and returns a Future for its result.
+    # callback, if set, is called with the Future once it is done.
+    def extract_async(self, callback=None, page_pool=None):
+        if page_pool is None:
+            page_pool = shared_page_pool
+        future = page_pool.submit(self.extract)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+# Shared by extract_async() so connections and per host limits carry across pages.
+shared_connection_pool = ConnectionPool()
+shared_opener = urllib2.build_opener(shared_connection_pool)
+shared_probe_pool = ProbePool(DEFAULT_MAX_PAGES * 2)
+shared_single_flight = SingleFlight()
+shared_host_health = HostHealth()
+shared_page_pool = WorkerPool(DEFAULT_MAX_PAGES)
             
-def extract(url_or_html, base_url=None):
-    star = StarImage(url_or_html, base_url)
-    return star.extract()
\ No newline at end of file
+def extract(url_or_html, base_url=None, **options):
+    star = StarImage(url_or_html, base_url, **options)
+    return star.extract()
+
+def extract_async(url_or_html, base_url=None, callback=None, **options):
+    options.setdefault('opener', shared_opener)
+    options.setdefault('probe_pool', shared_probe_pool)
+    star = StarImage(url_or_html, base_url, **options)
+    return star.extract_async(callback)
+
+def extract_ranked(url_or_html, k=None, base_url=None, **options):
+    star = StarImage(url_or_html, base_url, **options)
+    return star.extract_ranked(k)
+
+# Generator of (url_or_html, result) pairs in the order the pages finish. At
+# most max_pages pages are in flight, and at most max_pages_per_host against
+# any one host, and urls_or_html is read lazily. Urls held back by
+# max_pages_per_host wait in a buffer of up to max_pages * 4 urls. The pages
+# share one connection pool, probe pool and ProbeMemo.
+def extract_many(urls_or_html, base_url=None, max_pages=DEFAULT_MAX_PAGES, max_pages_per_host=None, **options):
+    options.setdefault('opener', shared_opener)
+    if 'probe_pool' not in options:
+        options['probe_pool'] = ProbePool(options.pop('max_workers', max_pages * 2),
+                                          options.pop('max_per_host', DEFAULT_MAX_PER_HOST))
+    options.setdefault('probe_memo', ProbeMemo())
+    page_pool = WorkerPool(max_pages)
+    finished = Queue.Queue()
+    inputs = iter(urls_or_html)
+    waiting = deque()
+    host_pages = {}
+    host_free = lambda item: max_pages_per_host is None or \
+        host_pages.get(page_host(item), 0) < max_pages_per_host
+    exhausted = False
+    in_flight = 0
+    while True:
+        while in_flight < max_pages:
+            url_or_html = None
+            for index, item in enumerate(waiting):
+                if host_free(item):
+                    url_or_html = item
+                    del waiting[index]
+                    break
+            while url_or_html is None and not exhausted and len(waiting) < max_pages * 4:
+                try:
+                    item = next(inputs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if host_free(item):
+                    url_or_html = item
+                else:
+                    waiting.append(item)
+            if url_or_html is None:
+                break
+            host = page_host(url_or_html)
+            host_pages[host] = host_pages.get(host, 0) + 1
+            future = StarImage(url_or_html, base_url, **options).extract_async(page_pool=page_pool)
+            future.add_done_callback(lambda done, item=url_or_html: finished.put((item, done)))
+            in_flight += 1
+        if in_flight == 0:
+            return
+        url_or_html, future = finished.get()
+        in_flight -= 1
+        host_pages[page_host(url_or_html)] -= 1
+        try:
+            result = future.result()
+        except Exception, e:
+            StarImage.handle_exception('Error extracting: ' + str(e))
+            result = None
+        yield url_or_html, result
+
+# Host of a page url, None for html.
+def page_host(url_or_html):
+    if StarImage.is_url(url_or_html):
+        return urlparse.urlparse(url_or_html).hostname
+    return None
+
+# A result with its ContentLength turned into a plain long so it can be
+# pickled and written as json.
+def plain_result(result):
+    if result is None:
+        return None
+    return dict((key, long(value) if isinstance(value, long) else value) for key, value in result.items())
+
+# Runs in each process of run_batch, extracting the urls put on inputs until
+# a None and putting (index, url, result) on results for each, then
+# (index, None, None) once it stops.
+def batch_worker(index, inputs, results, options):
+    try:
+        for url, result in extract_many(iter(inputs.get, None), **options):
+            results.put((index, url, plain_result(result)))
+    finally:
+        results.put((index, None, None))
+
+# Urls already in the jsonl file at path. A line cut short by a crash is ignored.
+def read_checkpoint(path):
+    done = set()
+    if path is None or not os.path.exists(path):
+        return done
+    with open(path) as checkpoint:
+        for line in checkpoint:
+            try:
+                done.add(json.loads(line)['url'])
+            except (ValueError, KeyError, TypeError):
+                continue
+    return done
+
+# Extracts every url of urls on settings.processes processes, writing a json
+# line of {"url": ..., "result": ...} to output as each page finishes. Urls
+# are given to processes by a hash of their host so per host limits hold
+# across the whole run. Each process is given at most max_pages * 5 urls at
+# a time, as many as extract_many can hold in flight and waiting. The rest
+# wait here, up to max_pages * 4 times the number of processes in all, so the
+# urls of one busy host never hold up the other processes. Urls in done are
+# skipped. Returns the counts of the summary written to progress. Raises
+# RuntimeError, once the other processes are stopped, if a process dies
+# before its urls are done.
+def run_batch(urls, settings, output, progress=sys.stderr, done=None):
+    done = done or set()
+    options = {'max_pages': settings.max_pages, 'max_pages_per_host': settings.per_domain,
+               'max_per_host': settings.max_per_host, 'timeout': settings.timeout,
+               'deadline': settings.deadline, 'rank_by': settings.rank_by}
+    processes = max(1, settings.processes)
+    inputs = [multiprocessing.Queue() for i in range(processes)]
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=batch_worker, args=(i, inputs[i], results, options))
+               for i in range(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    counts = {'done': 0, 'failed': 0, 'skipped': 0}
+    started = reported = time.time()
+    waiting = [deque() for i in range(processes)]
+    in_flight = [0] * processes
+    closed = [False] * processes
+    finished = [False] * processes
+    urls = iter(urls)
+    exhausted = False
+    def dispatch(index):
+        while len(waiting[index]) > 0 and in_flight[index] < settings.max_pages * 5:
+            inputs[index].put(waiting[index].popleft())
+            in_flight[index] += 1
+    try:
+        while not all(finished):
+            for index in range(processes):
+                dispatch(index)
+            while not exhausted and sum(len(queue) for queue in waiting) < settings.max_pages * 4 * processes:
+                url = next(urls, None)
+                if url is None:
+                    exhausted = True
+                    break
+                url = url.strip()
+                if not url or url.startswith('#'):
+                    continue
+                if url in done:
+                    counts['skipped'] += 1
+                    continue
+                done.add(url)
+                index = (zlib.crc32(page_host(url) or '') & 0xffffffff) % processes
+                waiting[index].append(url)
+                dispatch(index)
+            for index in range(processes):
+                if exhausted and len(waiting[index]) == 0 and not closed[index]:
+                    inputs[index].put(None)
+                    closed[index] = True
+            try:
+                index, url, result = results.get(True, BATCH_POLL_SECONDS)
+            except Queue.Empty:
+                for index, worker in enumerate(workers):
+                    if not finished[index] and not worker.is_alive():
+                        raise RuntimeError('starimage batch process %d died with exit code %s'
+                                           % (index, worker.exitcode))
+                continue
+            if url is None:
+                if not closed[index] or in_flight[index] > 0:
+                    raise RuntimeError('starimage batch process %d stopped before its urls were done' % index)
+                finished[index] = True
+                continue
+            in_flight[index] -= 1
+            write_batch_result(output, url, result, counts)
+            if settings.progress_interval is not None and time.time() - reported >= settings.progress_interval:
+                reported = time.time()
+                write_batch_progress(progress, counts, started, 'progress')
+    finally:
+        for worker in workers:
+            if worker.is_alive() and not all(finished):
+                worker.terminate()
+            worker.join()
+    write_batch_progress(progress, counts, started, 'finished')
+    return counts
+
+def write_batch_result(output, url, result, counts):
+    output.write(json.dumps({'url': url, 'result': result}, sort_keys=True) + '\n')
+    output.flush()
+    counts['done'] += 1
+    if result is None:
+        counts['failed'] += 1
+
+def write_batch_progress(progress, counts, started, label):
+    seconds = max(time.time() - started, 0.001)
+    progress.write('starimage %s: %d done, %d without an image, %d skipped, %.1f pages/sec, %.1fs\n'
+                   % (label, counts['done'], counts['failed'], counts['skipped'], counts['done'] / seconds, seconds))
+    progress.flush()
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog='python -m starimage',
+                                     description='Find the largest image of each url, one json line per url.')
+    parser.add_argument('input', nargs='?', default='-', help='file of urls, one a line (default stdin)')
+    parser.add_argument('--output', help='jsonl file to append to, urls already in it are skipped (default stdout)')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--max-pages', type=int, default=DEFAULT_MAX_PAGES, help='pages in flight in each process')
+    parser.add_argument('--per-domain', type=int, default=None, help='pages in flight on any one domain')
+    parser.add_argument('--max-per-host', type=int, default=DEFAULT_MAX_PER_HOST,
+                        help='image probes in flight on any one host in each process')
+    parser.add_argument('--timeout', type=float, default=None)
+    parser.add_argument('--deadline', type=float, default=None)
+    parser.add_argument('--rank-by', choices=['size', 'area'], default='size')
+    parser.add_argument('--progress-interval', type=float, default=10)
+    return parser.parse_args(args)
+
+def main(args):
+    settings = parse_args(args)
+    urls = sys.stdin if settings.input == '-' else open(settings.input)
+    try:
+        if settings.output is None:
+            run_batch(urls, settings, sys.stdout)
+        else:
+            done = read_checkpoint(settings.output)
+            with open(settings.output, 'a+') as output:
+                # Finish off a line cut short by a crash so the next result starts a line.
+                output.seek(0, os.SEEK_END)
+                if output.tell() > 0:
+                    output.seek(-1, os.SEEK_END)
+                    if output.read(1) != '\n':
+                        output.write('\n')
+                run_batch(urls, settings, output, done=done)
+    finally:
+        if urls is not sys.stdin:
+            urls.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,287 @@
+# BENCHMARKS:
+#
+# Measures the throughput and latency of starimage against a local HTTP server
+# that serves synthetic pages and images, so no real web requests are made.
+#
+#   python starimage_bench.py [options]
+#
+#   Options:
+#       --pages N            pages extracted in each mode (default 200)
+#       --images N           <img /> tags on each page (default 40)
+#       --page-bytes N       size of each page in bytes, padded (default 50000)
+#       --duplicates R       ratio of images shared by every page (default 0.25)
+#       --latency S          seconds the server waits before each response (default 0.005)
+#       --missing-length R   ratio of images sent without Content-Length (default 0.1)
+#       --max-per-host N     max_per_host option for every mode, all images are
+#                            on the one local host (default 16)
+#       --modes M,M          modes to run, from: serial, extract, streaming,
+#                            extract_async, extract_many (default all)
+#       --output FILE        write the json report to FILE as well as stdout
+#       --compare FILE       print the change against an earlier json report
+#
+#   Each mode runs in its own process so its peak memory can be measured.
+#   For every mode the report has pages_per_sec, probes_per_sec (requests made
+#   to image urls per second), p50_ms and p99_ms page latency and
+#   peak_rss_kb, the growth in peak resident memory over the run.
+#
+# Author: Joshua Garner
+
+import starimage
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+import urlparse
+
+MODES = ['serial', 'extract', 'streaming', 'extract_async', 'extract_many']
+
+# Serves /page/<n> and /img/<n>.jpg from the settings of the server.
+class SyntheticHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.__respond(send_body=False)
+
+    def do_GET(self):
+        self.__respond(send_body=True)
+
+    def __respond(self, send_body):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        path = urlparse.urlparse(self.path).path
+        if path.startswith('/page/'):
+            server.count('page')
+            self.__send(200, server.page(int(path[len('/page/'):])), 'text/html', send_body)
+        elif path.startswith('/img/'):
+            server.count('probe')
+            number = int(path[len('/img/'):].split('.')[0])
+            self.__send_image(number, send_body)
+        else:
+            self.__send(404, '', 'text/plain', send_body)
+
+    def __send_image(self, number, send_body):
+        server = self.server
+        size = server.image_size(number)
+        if server.missing_length(number):
+            # No Content-Length, the body is sent in full and the connection closed.
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = 1
+            if send_body:
+                self.wfile.write('\0' * size)
+            return
+        range_header = self.headers.getheader('Range')
+        if range_header is not None and send_body:
+            start, end = [int(n) for n in range_header[len('bytes='):].split('-')]
+            end = min(end, size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            self.wfile.write('\0' * (end - start + 1))
+            return
+        self.__send(200, '\0' * size, 'image/jpeg', send_body)
+
+    def __send(self, code, body, content_type, send_body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class SyntheticServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, settings):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), SyntheticHandler)
+        self.images = settings.images
+        self.page_bytes = settings.page_bytes
+        self.duplicates = settings.duplicates
+        self.latency = settings.latency
+        self.missing_ratio = settings.missing_length
+        self.counts = multiprocessing.Array('l', 2)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+    def count(self, kind):
+        index = 0 if kind == 'page' else 1
+        with self.counts.get_lock():
+            self.counts[index] += 1
+
+    def image_size(self, number):
+        return 1000 + (number * 7919) % 200000
+
+    def missing_length(self, number):
+        return (number * 2654435761 % 1000) < self.missing_ratio * 1000
+
+    # Duplicated images use the same numbers on every page, the rest are
+    # unique. Image urls are absolute as starimage drops the port from the
+    # base url it makes from a page url.
+    def page(self, page_number):
+        shared = int(self.images * self.duplicates)
+        tags = []
+        for i in range(self.images):
+            if i < shared:
+                number = i
+            else:
+                number = 1000000 + page_number * self.images + i
+            tags.append('<div class="item"><img src="%s" width="%d" /></div>'
+                        % (self.url('/img/%d.jpg' % number), 50 + i))
+        random.Random(page_number).shuffle(tags)
+        html = '<html><head><title>page %d</title></head><body>%s' % (page_number, ''.join(tags))
+        padding = self.page_bytes - len(html) - len('</body></html>')
+        if padding > 0:
+            html += '<p>' + 'x' * max(padding - 7, 0) + '</p>'
+        return html + '</body></html>'
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def run_mode(mode, urls, max_per_host):
+    latencies = []
+    started = time.time()
+    if mode == 'serial':
+        for url in urls:
+            start = time.time()
+            starimage.extract(url, max_workers=1)
+            latencies.append(time.time() - start)
+    elif mode == 'extract':
+        for url in urls:
+            start = time.time()
+            starimage.extract(url, max_per_host=max_per_host)
+            latencies.append(time.time() - start)
+    elif mode == 'streaming':
+        for url in urls:
+            start = time.time()
+            starimage.extract(url, streaming=True, max_per_host=max_per_host)
+            latencies.append(time.time() - start)
+    elif mode == 'extract_async':
+        done = threading.Semaphore(0)
+        def finished(future, start=None):
+            latencies.append(time.time() - start)
+            done.release()
+        # Same size as starimage.shared_probe_pool, but with --max-per-host.
+        probe_pool = starimage.ProbePool(starimage.DEFAULT_MAX_PAGES * 2, max_per_host)
+        for url in urls:
+            starimage.extract_async(url, probe_pool=probe_pool,
+                                    callback=lambda future, start=time.time(): finished(future, start))
+        for url in urls:
+            done.acquire()
+    elif mode == 'extract_many':
+        # Pages are queued at once so latency includes the wait for a page slot.
+        start = time.time()
+        for url, result in starimage.extract_many(urls, max_per_host=max_per_host):
+            latencies.append(time.time() - start)
+    return time.time() - started, latencies
+
+def run_mode_in_process(mode, urls, server, max_per_host, results):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    probes_before = server.counts[1]
+    seconds, latencies = run_mode(mode, urls, max_per_host)
+    probes = server.counts[1] - probes_before
+    results.put({
+        'mode': mode,
+        'pages': len(urls),
+        'seconds': round(seconds, 4),
+        'pages_per_sec': round(len(urls) / seconds, 2),
+        'probes': probes,
+        'probes_per_sec': round(probes / seconds, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline,
+    })
+
+def run(settings):
+    server = SyntheticServer(settings)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    urls = [server.url('/page/%d' % n) for n in range(settings.pages)]
+    report = {
+        'python': platform.python_version(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': vars(settings).copy(),
+        'modes': {},
+    }
+    del report['settings']['output']
+    del report['settings']['compare']
+    try:
+        for mode in settings.modes:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_mode_in_process, args=(mode, urls, server, settings.max_per_host, results))
+            process.start()
+            report['modes'][mode] = results.get()
+            process.join()
+            sys.stderr.write('%(mode)s: %(pages_per_sec)s pages/sec, %(probes_per_sec)s probes/sec, '
+                             'p50 %(p50_ms)sms, p99 %(p99_ms)sms, peak rss +%(peak_rss_kb)sKB\n'
+                             % report['modes'][mode])
+    finally:
+        server.shutdown()
+        server.server_close()
+    return report
+
+# Percentage change of each metric against an earlier report.
+def compare(report, previous):
+    changes = {}
+    for mode, metrics in report['modes'].items():
+        if mode not in previous.get('modes', {}):
+            continue
+        changes[mode] = {}
+        for name in ['pages_per_sec', 'probes_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_kb']:
+            before = previous['modes'][mode].get(name)
+            if before:
+                changes[mode][name] = round((metrics[name] - before) * 100.0 / before, 1)
+    return changes
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark starimage against a local server.')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--page-bytes', type=int, default=50000)
+    parser.add_argument('--duplicates', type=float, default=0.25)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--missing-length', type=float, default=0.1)
+    parser.add_argument('--max-per-host', type=int, default=16)
+    parser.add_argument('--modes', type=lambda value: value.split(','), default=MODES)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    settings = parser.parse_args(args)
+    for mode in settings.modes:
+        if mode not in MODES:
+            parser.error('unknown mode: ' + mode)
+    return settings
+
+def main(args):
+    settings = parse_args(args)
+    report = run(settings)
+    if settings.compare:
+        with open(settings.compare) as previous:
+            report['changes_percent'] = compare(report, json.load(previous))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if settings.output:
+        with open(settings.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print output
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -49,6 +49,90 @@ import mock
 from mock import Mock, patch
 import urllib2
 import unittest
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+import os
+import tempfile
+import shutil
+import StringIO
+import struct
+import socket
+import multiprocessing
+import json
+import zlib
+import gzip
+
+# Local HTTP/1.1 server for the connection tests, counts the connections made.
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = '<html><body><img src="/a.gif" /></body></html>'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '123')
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+# Minimal image headers for the pixel size tests.
+PNG_HEADER = '\x89PNG\r\n\x1a\n' + '\x00\x00\x00\x0dIHDR' + struct.pack('>II', 640, 480) + '\x08\x06\x00\x00\x00'
+GIF_HEADER = 'GIF89a' + struct.pack('<HH', 300, 200) + '\x00' * 10
+WEBP_HEADER = 'RIFF\x00\x00\x00\x00WEBPVP8X' + '\x00' * 8 + '\x1f\x03\x00' + '\xdf\x01\x00'
+JPEG_HEADER = ('\xff\xd8' + '\xff\xe1' + struct.pack('>H', 5002) + '\x00' * 5000 +
+               '\xff\xc0' + struct.pack('>HBHH', 17, 8, 1080, 1920) + '\x00' * 100)
+
+# Response of a server that honours Range requests for the bytes of data.
+def range_response(request, data):
+    start, end = [int(n) for n in request.get_header('Range')[len('bytes='):].split('-')]
+    response = StringIO.StringIO(data[start:end + 1])
+    response.getcode = lambda: 206
+    response.headers = {'content-range': 'bytes %d-%d/%d' % (start, end, len(data))}
+    return response
+
+# Answers every request after delay seconds.
+class SlowHandler(KeepAliveHandler):
+    delay = 0.5
+
+    def do_HEAD(self):
+        time.sleep(self.delay)
+        KeepAliveHandler.do_HEAD(self)
+
+    # The client has given up by the time the answer is sent.
+    def handle(self):
+        try:
+            KeepAliveHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            KeepAliveHandler.finish(self)
+        except socket.error:
+            pass
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def start_local_server(handler_class=KeepAliveHandler):
+    server = LocalServer(('127.0.0.1', 0), handler_class)
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
 
 class TestStarImage(unittest.TestCase):    
         
@@ -152,6 +236,110 @@ class TestStarImage(unittest.TestCase):
         urlopen_mock.return_value = my_mock
         self.assertEquals(starimage.StarImage.get_url_content_length('http://invalidurl.com'), 100)                                    
                                        
+    @patch('urllib2.urlopen')
+    def test_get_url_content_length_returns_validators_from_header(self, urlopen_mock):
+        my_mock = Mock()
+        my_mock.headers = {'content-length': 100, 'etag': '"abc"', 'last-modified': 'Sat, 01 Jan 2000 00:00:00 GMT'}
+        urlopen_mock.return_value = my_mock
+        content_length = starimage.StarImage.get_url_content_length('http://a.com/1.gif')
+        self.assertEquals(content_length.etag, '"abc"')
+        self.assertEquals(content_length.last_modified, 'Sat, 01 Jan 2000 00:00:00 GMT')
+
+    @patch('urllib2.urlopen')
+    def test_get_url_content_length_sends_conditional_headers(self, urlopen_mock):
+        urlopen_mock.side_effect = urllib2.HTTPError('http://a.com/1.gif', 304, 'Not Modified', {}, None)
+        content_length = starimage.StarImage.get_url_content_length('http://a.com/1.gif', etag='"abc"')
+        self.assertTrue(content_length.not_modified)
+        self.assertEquals(urlopen_mock.call_args[0][0].get_header('If-none-match'), '"abc"')
+
+    @patch('urllib2.urlopen')
+    def test_get_url_content_length_falls_back_to_range_request_when_head_rejected(self, urlopen_mock):
+        def urlopen(request):
+            if request.get_method() == 'HEAD':
+                raise urllib2.HTTPError(request.get_full_url(), 405, 'Method Not Allowed', {}, None)
+            return range_response(request, 'x' * 5000)
+        urlopen_mock.side_effect = urlopen
+        content_length = starimage.StarImage.get_url_content_length('http://a.com/1.gif')
+        self.assertEquals(content_length, 5000)
+        self.assertEquals(content_length.method, 'range')
+
+    @patch('urllib2.urlopen')
+    def test_get_url_content_length_counts_body_when_no_length_header(self, urlopen_mock):
+        def urlopen(request):
+            if request.get_method() == 'HEAD':
+                head = Mock()
+                head.headers = {}
+                return head
+            response = StringIO.StringIO('x' * 300)
+            response.getcode = lambda: 200
+            response.headers = {}
+            return response
+        urlopen_mock.side_effect = urlopen
+        content_length = starimage.StarImage.get_url_content_length('http://a.com/1.gif')
+        self.assertEquals(content_length, 300)
+        self.assertEquals(content_length.method, 'stream')
+        content_length = starimage.StarImage.get_url_content_length('http://a.com/1.gif', max_fallback_bytes=100)
+        self.assertEquals(content_length, 100)
+        self.assertEquals(content_length.method, 'stream-capped')
+
+    @patch('urllib2.urlopen')
+    def test_get_url_content_length_does_not_fall_back_on_network_errors(self, urlopen_mock):
+        urlopen_mock.side_effect = urllib2.URLError('error')
+        self.assertEquals(starimage.StarImage.get_url_content_length('http://a.com/1.gif'), 0)
+        self.assertEquals(urlopen_mock.call_count, 1)
+
+    @patch('urllib2.urlopen')
+    def test_get_url_content_length_passes_timeout(self, urlopen_mock):
+        my_mock = Mock()
+        my_mock.headers = {'content-length': 100}
+        urlopen_mock.return_value = my_mock
+        starimage.StarImage.get_url_content_length('http://a.com/1.gif', timeout=2.5)
+        self.assertEquals(urlopen_mock.call_args[1]['timeout'], 2.5)
+
+    # test ImageHeaderParser.feed(data, data_offset=0)
+    def test_image_header_parser_reads_png_gif_and_webp_sizes(self):
+        for header, size in [(PNG_HEADER, (640, 480)), (GIF_HEADER, (300, 200)), (WEBP_HEADER, (800, 480))]:
+            parser = starimage.ImageHeaderParser()
+            self.assertTrue(parser.feed(header))
+            self.assertEquals((parser.width, parser.height), size)
+
+    def test_image_header_parser_asks_for_jpeg_bytes_after_exif(self):
+        parser = starimage.ImageHeaderParser()
+        self.assertFalse(parser.feed(JPEG_HEADER[:1024]))
+        self.assertEquals(parser.position, 5006)
+        self.assertTrue(parser.feed(JPEG_HEADER[5006:6030], 5006))
+        self.assertEquals((parser.width, parser.height), (1920, 1080))
+
+    def test_image_header_parser_gives_up_on_unknown_format(self):
+        parser = starimage.ImageHeaderParser()
+        self.assertTrue(parser.feed('<svg xmlns="http://www.w3.org/2000/svg"></svg>'))
+        self.assertIsNone(parser.width)
+
+    # test StarImage.get_url_dimensions(url)
+    @patch('urllib2.urlopen')
+    def test_get_url_dimensions_reads_jpeg_with_range_requests(self, urlopen_mock):
+        urlopen_mock.side_effect = lambda request: range_response(request, JPEG_HEADER)
+        dimensions = starimage.StarImage.get_url_dimensions('http://a.com/1.jpg')
+        self.assertEquals(dimensions, (1920, 1080, len(JPEG_HEADER)))
+        self.assertEquals(urlopen_mock.call_count, 2)
+
+    @patch('urllib2.urlopen')
+    def test_get_url_dimensions_stops_reading_when_range_is_ignored(self, urlopen_mock):
+        response = StringIO.StringIO(PNG_HEADER + '\x00' * 100000)
+        response.getcode = lambda: 200
+        response.headers = {'content-length': str(len(response.getvalue()))}
+        urlopen_mock.return_value = response
+        self.assertEquals(starimage.StarImage.get_url_dimensions('http://a.com/1.png'), (640, 480, len(PNG_HEADER) + 100000))
+        self.assertTrue(response.closed)
+
+    @patch('urllib2.urlopen')
+    def test_get_url_dimensions_reports_http_status(self, urlopen_mock):
+        urlopen_mock.side_effect = urllib2.HTTPError('http://a.com/1.png', 404, 'Not Found', {}, None)
+        dimensions = starimage.StarImage.get_url_dimensions('http://a.com/1.png')
+        self.assertEquals(dimensions, (None, None, None))
+        self.assertEquals(dimensions.status, 404)
+        self.assertTrue(dimensions.error is not None)
+
     # test StarImage.__get_doc_from_url(self, url)
     @patch('urllib2.urlopen')
     def test_get_doc_from_url_raises_ioerror_with_invalid_url(self, parse_mock):
@@ -192,12 +380,12 @@ class TestStarImage(unittest.TestCase):
         self.star.url_or_html = '<div>Hi</div>'
         self.assertIsInstance(self.star._StarImage__get_doc(), lxml.etree._Element)  
 
-    def test_get_doc_makes_imgs_absolute_with_base_url(self):
-        self.star.url_or_html = '<html><body><img src="/img1.gif" /></body></html>'
+    def test_get_doc_leaves_links_as_they_are_with_base_url(self):
+        self.star.url_or_html = '<html><body><a href="/a.html"><img src="/img1.gif" /></a></body></html>'
         self.star.base_url = 'http://example.com'
         doc = self.star._StarImage__get_doc()
-        imgs = doc.xpath('//img')
-        self.assertEquals(imgs[0].get('src'), 'http://example.com/img1.gif')
+        self.assertEquals(doc.xpath('//img')[0].get('src'), '/img1.gif')
+        self.assertEquals(doc.xpath('//a')[0].get('href'), '/a.html')
         
     # test StarImage.__get_images(doc)
     def test_get_images_return_none_if_doc_is_none(self):
@@ -237,6 +425,34 @@ class TestStarImage(unittest.TestCase):
         image_details = self.star._StarImage__get_image_details(imgs)
         self.assertEquals(len(image_details), 1)
 
+    def test_get_image_details_makes_image_urls_absolute_with_base_url(self):
+        self.star.url_or_html = '<html><body><img src="/img1.gif" /><img src=" img2.gif" /></body></html>'
+        self.star.base_url = 'http://example.com'
+        doc = self.star._StarImage__get_doc()
+        imgs = self.star._StarImage__get_images(doc)
+        image_details = self.star._StarImage__get_image_details(imgs)
+        self.assertEquals([detail['url'] for detail in image_details],
+                          ['http://example.com/img1.gif', 'http://example.com/img2.gif'])
+
+    def test_get_image_details_makes_image_urls_absolute_with_base_href(self):
+        self.star.url_or_html = ('<html><head><base href="http://cdn.com/images/" /></head>'
+                                 '<body><img src="img1.gif" /><img src="/img2.gif" /></body></html>')
+        self.star.base_url = 'http://example.com'
+        doc = self.star._StarImage__get_doc()
+        imgs = self.star._StarImage__get_images(doc)
+        image_details = self.star._StarImage__get_image_details(imgs)
+        self.assertEquals([detail['url'] for detail in image_details],
+                          ['http://cdn.com/images/img1.gif', 'http://cdn.com/img2.gif'])
+
+    def test_get_image_details_keeps_order_of_first_use(self):
+        self.star.url_or_html = ('<div><img src="http://a.com/1.gif" /><img src="http://a.com/2.gif" width="5" />'
+                                 '<img src="http://a.com/1.gif" width="9" /></div>')
+        doc = self.star._StarImage__get_doc()
+        imgs = self.star._StarImage__get_images(doc)
+        image_details = self.star._StarImage__get_image_details(imgs)
+        self.assertEquals([(detail['url'], detail['width']) for detail in image_details],
+                          [('http://a.com/1.gif', None), ('http://a.com/2.gif', 5)])
+
     def test_get_image_details_returns_details(self):
         self.star.url_or_html = '<html><header></header><body><img src="http://b.com/a.gif" width="200" height="300" /></body></html>'
         doc = self.star._StarImage__get_doc()
@@ -274,7 +490,1030 @@ class TestStarImage(unittest.TestCase):
         self.assertEquals(details['size'], 500)
         self.assertEquals(details['width'], 100)
         self.assertEquals(details['height'], 300)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_get_largest_image_returns_size_method(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = starimage.ContentLength(100, method='range')
+        details = starimage.extract('<div><img src="http://a.com/1.gif" /></div>')
+        self.assertEquals(details['size_method'], 'range')
     
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_get_largest_image_keeps_first_image_on_tied_size(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        self.star.url_or_html = TestStarImage.html
+        doc = self.star._StarImage__get_doc()
+        imgs = self.star._StarImage__get_images(doc)
+        details = self.star._StarImage__get_largest_image(imgs)
+        self.assertEquals(details['url'], 'http://a.com/1.gif')
+
+    @patch.object(starimage.StarImage, 'get_url_dimensions')
+    def test_get_largest_image_ranks_by_pixel_area(self, get_url_dimensions_mock):
+        dimensions = {'http://a.com/1.gif': (10, 10, 9000), 'http://a.com/2.gif': (200, 100, 500),
+                      'http://a.com/3.gif': (None, None, 700)}
+        get_url_dimensions_mock.side_effect = lambda url, **kwargs: dimensions.get(url, (None, None, None))
+        details = starimage.extract(TestStarImage.html, rank_by='area')
+        self.assertEquals(details['url'], 'http://a.com/2.gif')
+        self.assertEquals(details['size'], 500)
+        self.assertEquals((details['pixel_width'], details['pixel_height']), (200, 100))
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_returns_complete_result(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        self.assertTrue(starimage.extract(TestStarImage.html, deadline=5)['complete'])
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_returns_best_so_far_when_deadline_passes(self, get_url_content_length_mock):
+        def get_content_length(url, **kwargs):
+            if url == 'http://a.com/2.gif':
+                time.sleep(0.3)
+            return self.get_content_length(url)
+        get_url_content_length_mock.side_effect = get_content_length
+        details = starimage.extract(TestStarImage.html, deadline=0.1)
+        self.assertEquals(details['url'], 'http://a.com/4.gif')
+        self.assertFalse(details['complete'])
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_cuts_request_timeout_to_deadline(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        starimage.extract(TestStarImage.html, timeout=30, deadline=5)
+        self.assertTrue(get_url_content_length_mock.call_args[1]['timeout'] <= 5)
+
+    # test ExtractStats
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_records_stats(self, get_url_content_length_mock):
+        def get_content_length(url, **kwargs):
+            if url == 'http://a.com/3.gif':
+                return starimage.ContentLength(0, error='timed out')
+            return starimage.ContentLength(self.get_content_length(url), method='head')
+        get_url_content_length_mock.side_effect = get_content_length
+        phases = []
+        stats = starimage.ExtractStats(on_phase=lambda phase, seconds: phases.append(phase))
+        html = TestStarImage.html.replace('</body>', '<img src="http://a.com/1.gif" /></body>')
+        starimage.extract(html, base_url='http://b.com', stats=stats)
+        metrics = stats.as_dict()
+        self.assertEquals(metrics['extracts'], 1)
+        self.assertEquals(metrics['probes_issued'], 7)
+        self.assertEquals(metrics['probes_succeeded'], 6)
+        self.assertEquals(metrics['size_method.head'], 6)
+        self.assertEquals(metrics['host_failures.a.com'], 1)
+        self.assertEquals(metrics['duplicates_skipped'], 1)
+        self.assertEquals(phases, ['parse', 'xpath', 'candidates', 'probe', 'select'])
+        self.assertTrue(metrics['phase.probe.seconds'] >= 0)
+
+    # test use_metadata
+    metadata_html = ('<html><head><meta property="og:image" content="/hero.jpg" />'
+                     '<meta property="og:image:width" content="1200" /><meta property="og:image:height" content="630" />'
+                     '<meta name="twitter:image" content="http://a.com/twitter.jpg" /></head>'
+                     '<body><img src="http://a.com/1.gif" /><img src="http://a.com/2.gif" /></body></html>')
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_uses_og_image_with_one_probe(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 80000
+        details = starimage.extract(TestStarImage.metadata_html, base_url='http://a.com', use_metadata=True)
+        self.assertEquals(details['url'], 'http://a.com/hero.jpg')
+        self.assertEquals((details['width'], details['height']), (1200, 630))
+        self.assertEquals(details['source'], 'og:image')
+        self.assertEquals(get_url_content_length_mock.call_count, 1)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_scans_images_when_metadata_image_has_no_size(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 0 if url == 'http://a.com/hero.jpg' else 100
+        details = starimage.extract(TestStarImage.metadata_html, base_url='http://a.com', use_metadata=True)
+        self.assertEquals(details['url'], 'http://a.com/1.gif')
+        self.assertEquals(details['source'], 'img')
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_ignores_metadata_by_default(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        details = starimage.extract(TestStarImage.metadata_html, base_url='http://a.com')
+        self.assertEquals(details['url'], 'http://a.com/1.gif')
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_streaming_stops_at_body_with_usable_metadata(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        urlopen_mock.return_value = StringIO.StringIO(TestStarImage.metadata_html.replace('og:image"', 'og:ignored"'))
+        details = starimage.extract('http://a.com/page.html', streaming=True, use_metadata=True)
+        self.assertEquals(details['url'], 'http://a.com/twitter.jpg')
+        self.assertEquals(details['source'], 'twitter:image')
+        self.assertEquals(get_url_content_length_mock.call_count, 1)
+
+    # test prioritize and max_probes
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_prioritized_probes_every_image(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: {'http://a.com/big.jpg': 500000}.get(url, 40)
+        html = ('<html><body><img src="http://a.com/pixel.gif" width="1" height="1" />'
+                '<img src="http://a.com/icon.png" width="16" height="16" />'
+                '<img src="http://a.com/big.jpg" width="800" height="600" /></body></html>')
+        details = starimage.extract(html, max_workers=1, prioritize=True)
+        self.assertEquals(details['url'], 'http://a.com/big.jpg')
+        self.assertEquals(details['probes_saved'], 0)
+        self.assertEquals([call[0][0] for call in get_url_content_length_mock.call_args_list],
+                          ['http://a.com/big.jpg', 'http://a.com/icon.png', 'http://a.com/pixel.gif'])
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_prioritized_finds_image_larger_than_its_declared_size(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: {'http://a.com/hero.jpg': 400000}.get(url, 200000)
+        html = ('<html><body><img src="http://a.com/photo.jpg" />'
+                '<img src="http://a.com/hero.jpg" width="80" height="60" /></body></html>')
+        details = starimage.extract(html, max_workers=1, prioritize=True)
+        self.assertEquals(details['url'], 'http://a.com/hero.jpg')
+        self.assertEquals(details['size'], 400000)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_prioritized_keeps_dom_order_on_ties(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        html = '<html><body><img src="http://a.com/1.gif" /><img src="http://a.com/2.gif" width="50" height="50" /></body></html>'
+        details = starimage.extract(html, prioritize=True)
+        self.assertEquals(details['url'], 'http://a.com/1.gif')
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_max_probes_probes_highest_priority_first(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 100
+        html = ('<html><body><img src="http://a.com/sprite.png" /><img src="http://a.com/small.jpg" width="10" height="10" />'
+                '<img src="http://a.com/large.jpg" width="400" height="300" /></body></html>')
+        details = starimage.extract(html, max_probes=1)
+        self.assertEquals(details['url'], 'http://a.com/large.jpg')
+        self.assertEquals(details['probes_saved'], 2)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_reports_no_probes_saved_by_default(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        details = starimage.extract('<html><body><img src="http://a.com/pixel.gif" width="1" height="1" /></body></html>')
+        self.assertEquals(details['probes_saved'], 0)
+
+    # test SingleFlight.do(key, fn, *args, **kwargs)
+    def test_single_flight_shares_call_between_concurrent_callers(self):
+        single_flight = starimage.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def probe(url):
+            calls.append(url)
+            started.set()
+            release.wait(5)
+            return 42
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('a', probe, 'http://a.com/1.gif')))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do('a', probe, 'http://a.com/1.gif')))
+                     for i in range(3)]
+        for follower in followers:
+            follower.start()
+        while single_flight.shared < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEquals(results, [42, 42, 42, 42])
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(single_flight.in_flight(), 0)
+
+    def test_single_flight_shares_exception(self):
+        single_flight = starimage.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        def probe():
+            started.set()
+            release.wait(5)
+            raise IOError('refused')
+        errors = []
+        def call():
+            try:
+                single_flight.do('a', probe)
+            except IOError, e:
+                errors.append(str(e))
+        threads = [threading.Thread(target=call)]
+        threads[0].start()
+        started.wait(5)
+        threads.append(threading.Thread(target=call))
+        threads[1].start()
+        while single_flight.shared < 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEquals(errors, ['refused', 'refused'])
+
+    def test_single_flight_runs_again_once_finished(self):
+        single_flight = starimage.SingleFlight()
+        self.assertEquals(single_flight.do('a', lambda: 1), 1)
+        self.assertEquals(single_flight.do('a', lambda: 2), 2)
+        self.assertEquals(single_flight.calls, 2)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_coalesces_probes_across_concurrent_extracts(self, get_url_content_length_mock):
+        release = threading.Event()
+        def probe(url, **kwargs):
+            release.wait(5)
+            return 100
+        get_url_content_length_mock.side_effect = probe
+        single_flight = starimage.SingleFlight()
+        html = '<html><body><img src="http://a.com/logo.gif" /></body></html>'
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(starimage.extract(html, single_flight=single_flight)))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        while single_flight.calls + single_flight.shared < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEquals([result['size'] for result in results], [100] * 4)
+        self.assertEquals(get_url_content_length_mock.call_count, 1)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_does_not_share_probe_cut_short_by_deadline(self, get_url_content_length_mock):
+        started = threading.Event()
+        release = threading.Event()
+        def probe(url, timeout=None, **kwargs):
+            if timeout is None:
+                return 100
+            started.set()
+            release.wait(5)
+            return starimage.ContentLength(0, error='timed out')
+        get_url_content_length_mock.side_effect = probe
+        single_flight = starimage.SingleFlight()
+        html = '<html><body><img src="http://a.com/logo.gif" /></body></html>'
+        leader = threading.Thread(target=lambda: starimage.extract(html, deadline=5, single_flight=single_flight))
+        leader.start()
+        started.wait(5)
+        try:
+            self.assertEquals(starimage.extract(html, single_flight=single_flight)['size'], 100)
+        finally:
+            release.set()
+            leader.join(5)
+        self.assertEquals((single_flight.calls, single_flight.shared), (1, 0))
+
+    # test HostHealth
+    def test_host_health_opens_circuit_after_failures_in_a_row(self):
+        host_health = starimage.HostHealth(failure_threshold=3)
+        host_health.record('a.com', 0.1, True)
+        host_health.record('a.com', 0.1, True)
+        self.assertEquals(host_health.state('a.com'), 'closed')
+        host_health.record('a.com', 0.1, True)
+        self.assertEquals(host_health.state('a.com'), 'open')
+        self.assertEquals(host_health.allow('a.com'), False)
+        self.assertEquals(host_health.allow('b.com'), True)
+
+    def test_host_health_lets_one_probe_through_when_half_open(self):
+        host_health = starimage.HostHealth(failure_threshold=1, recovery_time=0)
+        host_health.record('a.com', 0.1, True)
+        self.assertEquals(host_health.allow('a.com'), True)
+        self.assertEquals(host_health.state('a.com'), 'half-open')
+        self.assertEquals(host_health.allow('a.com'), False)
+        host_health.record('a.com', 0.1, True)
+        self.assertEquals(host_health.state('a.com'), 'open')
+        self.assertEquals(host_health.allow('a.com'), True)
+        host_health.record('a.com', 0.1, False)
+        self.assertEquals(host_health.state('a.com'), 'closed')
+
+    def test_host_health_snapshot(self):
+        host_health = starimage.HostHealth(alpha=0.5)
+        host_health.record('a.com', 1.0, False)
+        host_health.record('a.com', 3.0, True)
+        snapshot = host_health.snapshot()
+        self.assertEquals(snapshot['a.com']['latency'], 2.0)
+        self.assertEquals(snapshot['a.com']['error_rate'], 0.5)
+        self.assertEquals(snapshot['a.com']['requests'], 2)
+        self.assertEquals(snapshot['a.com']['failures'], 1)
+        self.assertEquals(snapshot['a.com']['state'], 'closed')
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_skips_probes_to_host_with_open_circuit(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: \
+            starimage.ContentLength(0, error='timed out') if 'dead.com' in url else 100
+        host_health = starimage.HostHealth(failure_threshold=2)
+        html = ('<html><body><img src="http://dead.com/1.gif" /><img src="http://dead.com/2.gif" />'
+                '<img src="http://dead.com/3.gif" /><img src="http://a.com/1.gif" /></body></html>')
+        stats = starimage.ExtractStats()
+        details = starimage.extract(html, max_workers=1, host_health=host_health, stats=stats)
+        self.assertEquals(details['url'], 'http://a.com/1.gif')
+        self.assertEquals(host_health.state('dead.com'), 'open')
+        self.assertEquals(get_url_content_length_mock.call_count, 3)
+        self.assertEquals(stats.as_dict()['probes_skipped'], 1)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_does_not_count_client_errors_against_host(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = starimage.ContentLength(0, error='not found', status=404)
+        host_health = starimage.HostHealth(failure_threshold=1)
+        starimage.extract('<html><body><img src="http://a.com/1.gif" /></body></html>', host_health=host_health)
+        self.assertEquals(host_health.state('a.com'), 'closed')
+
+    @patch.object(starimage.StarImage, 'get_url_dimensions')
+    def test_extract_by_area_does_not_count_client_errors_against_host(self, get_url_dimensions_mock):
+        get_url_dimensions_mock.side_effect = lambda url, **kwargs: \
+            starimage.Dimensions(error='not found', status=404) if 'gone' in url else starimage.Dimensions()
+        host_health = starimage.HostHealth(failure_threshold=1)
+        html = '<html><body><img src="http://a.com/gone.gif" /><img src="http://a.com/1.svg" /></body></html>'
+        starimage.extract(html, rank_by='area', host_health=host_health)
+        self.assertEquals(host_health.state('a.com'), 'closed')
+        get_url_dimensions_mock.side_effect = lambda url, **kwargs: starimage.Dimensions(error='timed out')
+        starimage.extract(html, rank_by='area', host_health=host_health)
+        self.assertEquals(host_health.state('a.com'), 'open')
+
+    def test_extract_does_not_count_deadline_timeouts_against_host(self):
+        server = start_local_server(SlowHandler)
+        try:
+            url = 'http://127.0.0.1:%d/slow.gif' % server.server_port
+            host_health = starimage.HostHealth(failure_threshold=1)
+            html = '<html><body><img src="%s" /></body></html>' % url
+            starimage.extract(html, deadline=0.1, host_health=host_health, single_flight=False)
+            self.assertEquals(host_health.state('127.0.0.1'), 'closed')
+            starimage.extract(html, timeout=0.1, host_health=host_health, single_flight=False)
+            self.assertEquals(host_health.state('127.0.0.1'), 'open')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_host_health_abandon_reopens_half_open_circuit(self):
+        host_health = starimage.HostHealth(failure_threshold=1, recovery_time=0)
+        host_health.record('a.com', 0.1, True)
+        self.assertEquals(host_health.allow('a.com'), True)
+        host_health.abandon('a.com')
+        self.assertEquals(host_health.state('a.com'), 'open')
+        self.assertEquals(host_health.allow('a.com'), True)
+
+    def test_extract_does_not_track_host_health_by_default(self):
+        self.assertEquals(starimage.StarImage('<html><body></body></html>').host_health, None)
+
+    # test page_cache
+    page_html = '<html><body><img src="http://a.com/1.gif" /></body></html>'
+
+    def page_response(self, request, **kwargs):
+        response = StringIO.StringIO(TestStarImage.page_html)
+        response.headers = {'etag': '"v1"', 'last-modified': 'Sat, 17 Oct 2026 10:00:00 GMT'}
+        return response
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_returns_fresh_page_cache_result_without_fetching(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        urlopen_mock.side_effect = self.page_response
+        cache = starimage.MemoryCache(ttl=60)
+        first = starimage.extract('http://a.com/page.html', page_cache=cache)
+        second = starimage.extract('http://a.com/page.html', page_cache=cache)
+        self.assertEquals(second, first)
+        self.assertEquals(urlopen_mock.call_count, 1)
+        self.assertEquals(get_url_content_length_mock.call_count, 1)
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_returns_page_cache_result_on_not_modified(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        urlopen_mock.side_effect = self.page_response
+        cache = starimage.MemoryCache(ttl=0)
+        stats = starimage.ExtractStats()
+        first = starimage.extract('http://a.com/page.html', page_cache=cache)
+        def not_modified(request, **kwargs):
+            self.assertEquals(request.get_header('If-none-match'), '"v1"')
+            self.assertEquals(request.get_header('If-modified-since'), 'Sat, 17 Oct 2026 10:00:00 GMT')
+            raise urllib2.HTTPError(request.get_full_url(), 304, 'Not Modified', {}, None)
+        urlopen_mock.side_effect = not_modified
+        second = starimage.extract('http://a.com/page.html', page_cache=cache, stats=stats)
+        self.assertEquals(second, first)
+        self.assertEquals(get_url_content_length_mock.call_count, 1)
+        self.assertEquals(cache.revalidated, 1)
+        self.assertEquals(stats.as_dict()['pages_cached'], 1)
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_page_cache_is_keyed_by_base_url(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        urlopen_mock.side_effect = self.page_response
+        directory = tempfile.mkdtemp()
+        try:
+            cache = starimage.SqliteCache(os.path.join(directory, 'pages.db'), table='pages')
+            starimage.extract('http://a.com/page.html', page_cache=cache)
+            starimage.extract('http://a.com/page.html', base_url='http://b.com', page_cache=cache)
+            details = starimage.extract('http://a.com/page.html', page_cache=cache)
+            self.assertEquals(urlopen_mock.call_count, 2)
+            self.assertEquals(details['url'], 'http://a.com/1.gif')
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_does_not_cache_page_that_failed_partway(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        def timed_out(request, **kwargs):
+            response = self.page_response(request)
+            response.read = Mock(side_effect=['<html><body>', socket.timeout('timed out')])
+            return response
+        for streaming in [False, True]:
+            urlopen_mock.reset_mock()
+            urlopen_mock.side_effect = timed_out
+            cache = starimage.MemoryCache(ttl=60)
+            starimage.extract('http://a.com/page.html', page_cache=cache, streaming=streaming)
+            urlopen_mock.side_effect = self.page_response
+            details = starimage.extract('http://a.com/page.html', page_cache=cache, streaming=streaming)
+            self.assertEquals(details['url'], 'http://a.com/1.gif')
+            self.assertEquals(urlopen_mock.call_count, 2)
+
+    # test extract_ranked(url_or_html, k=None, base_url=None, **options)
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_ranked_yields_candidates_as_probes_finish(self, get_url_content_length_mock):
+        release = threading.Event()
+        def probe(url, **kwargs):
+            if url == 'http://a.com/slow.gif':
+                release.wait(5)
+                return 500
+            return {'http://a.com/1.gif': 100, 'http://a.com/2.gif': 300}[url]
+        get_url_content_length_mock.side_effect = probe
+        html = ('<html><body><img src="http://a.com/slow.gif" /><img src="http://a.com/1.gif" />'
+                '<img src="http://a.com/2.gif" width="20" /></body></html>')
+        ranked = starimage.extract_ranked(html, k=2)
+        first = [next(ranked), next(ranked)]
+        self.assertEquals(sorted(candidate.url for candidate in first), ['http://a.com/1.gif', 'http://a.com/2.gif'])
+        self.assertEquals([candidate.url for candidate in ranked.top()], ['http://a.com/2.gif', 'http://a.com/1.gif'])
+        release.set()
+        top = ranked.wait()
+        self.assertEquals([(candidate.url, candidate.size) for candidate in top],
+                          [('http://a.com/slow.gif', 500), ('http://a.com/2.gif', 300)])
+        self.assertEquals(top[1]['width'], 20)
+        self.assertEquals(top[1].as_dict()['filename'], '2.gif')
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_ranked_top_keeps_dom_order_on_ties(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        html = '<html><body><img src="http://a.com/1.gif" /><img src="http://a.com/2.gif" /><img src="http://a.com/3.gif" /></body></html>'
+        top = starimage.extract_ranked(html, k=2).wait()
+        self.assertEquals([candidate.url for candidate in top], ['http://a.com/1.gif', 'http://a.com/2.gif'])
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_ranked_probes_at_most_max_probes_in_priority_order(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        html = ('<html><body><img src="http://a.com/sprite.png" /><img src="http://a.com/small.jpg" width="10" height="10" />'
+                '<img src="http://a.com/large.jpg" width="400" height="300" /></body></html>')
+        top = starimage.extract_ranked(html, max_workers=1, max_probes=2).wait()
+        self.assertEquals([candidate.url for candidate in top], ['http://a.com/small.jpg', 'http://a.com/large.jpg'])
+        self.assertEquals([call[0][0] for call in get_url_content_length_mock.call_args_list],
+                          ['http://a.com/large.jpg', 'http://a.com/small.jpg'])
+
+    def test_extract_ranked_yields_nothing_without_a_page(self):
+        self.assertEquals(list(starimage.extract_ranked(None)), [])
+
+    def test_candidate_has_no_instance_dict(self):
+        candidate = starimage.Candidate('http://a.com/1.gif', 10, 20, 0)
+        self.assertFalse(hasattr(candidate, '__dict__'))
+        self.assertEquals((candidate['url'], candidate['width'], candidate['height']), ('http://a.com/1.gif', 10, 20))
+        self.assertRaises(KeyError, lambda: candidate['missing'])
+
+    # test PageDecoder(content_encoding=None, max_bytes=8MB)
+    def gzip_bytes(self, data):
+        output = StringIO.StringIO()
+        gzip_file = gzip.GzipFile(fileobj=output, mode='wb')
+        gzip_file.write(data)
+        gzip_file.close()
+        return output.getvalue()
+
+    def test_page_decoder_decompresses_gzip_in_chunks(self):
+        data = self.gzip_bytes('<html>' + 'x' * 10000 + '</html>')
+        decoder = starimage.PageDecoder('gzip')
+        decoded = ''.join(decoder.feed(data[i:i + 100]) for i in range(0, len(data), 100))
+        self.assertEquals(decoded, '<html>' + 'x' * 10000 + '</html>')
+        self.assertFalse(decoder.truncated)
+
+    def test_page_decoder_decompresses_raw_deflate(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress('<html></html>') + compressor.flush()
+        self.assertEquals(starimage.PageDecoder('deflate').feed(data), '<html></html>')
+
+    def test_page_decoder_caps_decompressed_bytes(self):
+        decoder = starimage.PageDecoder('gzip', max_bytes=1000)
+        decoded = decoder.feed(self.gzip_bytes('x' * 10000000))
+        self.assertEquals(len(decoded), 1000)
+        self.assertTrue(decoder.truncated)
+        self.assertEquals(decoder.feed('more'), '')
+
+    def test_get_page_encoding_prefers_header_to_meta(self):
+        html = '<html><head><meta charset="iso-8859-1"></head></html>'
+        self.assertEquals(StarImage.get_page_encoding({'content-type': 'text/html; charset=UTF-8'}, html), 'UTF-8')
+        self.assertEquals(StarImage.get_page_encoding({}, html), 'iso-8859-1')
+        self.assertEquals(StarImage.get_page_encoding({'content-type': 'text/html; charset=EUC-JP'}), 'EUC-JP')
+        self.assertIsNone(StarImage.get_page_encoding({'content-type': 'text/html; charset=nonsense'}))
+        self.assertIsNone(StarImage.get_page_encoding({'content-type': 'text/html; charset=euc_jp'}))
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_decodes_euc_jp_page(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        html = (u'<html><head><meta http-equiv="Content-Type" content="text/html; charset=EUC-JP"></head>'
+                u'<body><p>\u65e5\u672c\u8a9e</p><img src="/\u732b.gif" /></body></html>').encode('euc_jp')
+        for headers in [{'content-type': 'text/html; charset=EUC-JP'}, {}]:
+            for streaming in [False, True]:
+                urlopen_mock.return_value = self.page_with_headers(html, headers)
+                details = starimage.extract('http://a.com/page.html', streaming=streaming)
+                self.assertEquals(details['url'], u'http://a.com/\u732b.gif')
+
+    # test max_page_bytes and compressed pages
+    def page_with_headers(self, body, headers):
+        response = StringIO.StringIO(body)
+        response.headers = headers
+        return response
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_reads_gzip_page(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        body = self.gzip_bytes('<html><body><img src="/1.gif" /></body></html>')
+        for streaming in [False, True]:
+            urlopen_mock.return_value = self.page_with_headers(body, {'content-encoding': 'gzip'})
+            details = starimage.extract('http://a.com/page.html', streaming=streaming)
+            self.assertEquals(details['url'], 'http://a.com/1.gif')
+            self.assertEquals(details['truncated'], False)
+        self.assertEquals(urlopen_mock.call_args[0][0].get_header('Accept-encoding'), 'gzip, deflate')
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_truncates_page_over_max_page_bytes(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        html = '<html><body><img src="/1.gif" />' + 'x' * 100000 + '<img src="/2.gif" /></body></html>'
+        for streaming in [False, True]:
+            urlopen_mock.return_value = self.page_with_headers(html, {})
+            details = starimage.extract('http://a.com/page.html', streaming=streaming, max_page_bytes=50000)
+            self.assertEquals(details['url'], 'http://a.com/1.gif')
+            self.assertEquals(details['truncated'], True)
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_decodes_page_with_header_charset(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.return_value = 100
+        html = u'<html><body><img src="/\u043a\u043e\u0442.gif" /></body></html>'.encode('cp1251')
+        urlopen_mock.return_value = self.page_with_headers(html, {'content-type': 'text/html; charset=windows-1251'})
+        details = starimage.extract('http://a.com/page.html')
+        self.assertEquals(details['url'], u'http://a.com/\u043a\u043e\u0442.gif')
+
+    # test run_batch(urls, settings, output, progress=sys.stderr, done=None)
+    def batch_page(self, request, opener=None, timeout=None):
+        url = request.get_full_url()
+        response = StringIO.StringIO('<html><body><img src="%s.jpg" /></body></html>' % url)
+        response.headers = {}
+        return response
+
+    @patch.object(starimage.StarImage, 'open_url')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_run_batch_writes_a_json_line_per_url_and_skips_done_urls(self, get_url_content_length_mock, open_url_mock):
+        get_url_content_length_mock.return_value = 100
+        open_url_mock.side_effect = self.batch_page
+        settings = starimage.parse_args(['--processes', '2', '--max-pages', '2', '--per-domain', '1'])
+        urls = ['http://a.com/1', 'http://b.com/1', 'http://a.com/2', '', '# comment', 'http://a.com/1']
+        output = StringIO.StringIO()
+        progress = StringIO.StringIO()
+        counts = starimage.run_batch(urls, settings, output, progress, done=set(['http://b.com/1']))
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEquals(sorted(line['url'] for line in lines), ['http://a.com/1', 'http://a.com/2'])
+        self.assertEquals(lines[0]['result']['url'], lines[0]['url'] + '.jpg')
+        self.assertEquals(lines[0]['result']['size'], 100)
+        self.assertEquals((counts['done'], counts['skipped']), (2, 2))
+        self.assertTrue(progress.getvalue().startswith('starimage finished: 2 done'))
+
+    @patch.object(starimage.StarImage, 'open_url')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_run_batch_does_not_hold_up_other_processes_behind_a_busy_one(self, get_url_content_length_mock,
+                                                                          open_url_mock):
+        get_url_content_length_mock.return_value = 100
+        fast_done = multiprocessing.Event()
+        def page(request, opener=None, timeout=None):
+            if 'fast.com' in request.get_full_url():
+                fast_done.set()
+            else:
+                fast_done.wait(5)
+            return self.batch_page(request)
+        open_url_mock.side_effect = page
+        settings = starimage.parse_args(['--processes', '2', '--max-pages', '1', '--per-domain', '1'])
+        # slow.com and fast.com go to different processes.
+        urls = ['http://slow.com/%d' % i for i in range(8)] + ['http://fast.com/1']
+        started = time.time()
+        counts = starimage.run_batch(urls, settings, StringIO.StringIO(), StringIO.StringIO())
+        self.assertEquals(counts['done'], 9)
+        self.assertTrue(time.time() - started < 4)
+
+    @patch.object(starimage.StarImage, 'open_url')
+    def test_run_batch_stops_when_a_process_dies(self, open_url_mock):
+        open_url_mock.side_effect = lambda request, opener=None, timeout=None: os._exit(1)
+        settings = starimage.parse_args(['--processes', '2'])
+        self.assertRaises(RuntimeError, starimage.run_batch, ['http://a.com/1', 'http://x.com/1'], settings,
+                          StringIO.StringIO(), StringIO.StringIO())
+
+    def test_read_checkpoint_ignores_cut_short_lines(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'results.jsonl')
+            with open(path, 'w') as output:
+                output.write('{"url": "http://a.com/1", "result": null}\n{"url": "http://a.com/2", "res')
+            self.assertEquals(starimage.read_checkpoint(path), set(['http://a.com/1']))
+            self.assertEquals(starimage.read_checkpoint(os.path.join(directory, 'missing.jsonl')), set())
+        finally:
+            shutil.rmtree(directory)
+
+    @patch.object(starimage.StarImage, 'extract_async')
+    def test_extract_many_limits_pages_per_host(self, extract_async_mock):
+        futures = []
+        def extract_async(page_pool=None):
+            future = starimage.Future()
+            futures.append(future)
+            return future
+        extract_async_mock.side_effect = extract_async
+        pages = starimage.extract_many(['http://a.com/1', 'http://a.com/2', 'http://b.com/1'], max_pages_per_host=1)
+        thread = threading.Thread(target=lambda: list(pages))
+        thread.start()
+        while len(futures) < 2:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        self.assertEquals(len(futures), 2)
+        futures[0].set_result(None)
+        while len(futures) < 3:
+            time.sleep(0.001)
+        futures[1].set_result(None)
+        futures[2].set_result(None)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    # test DomainProfiles and domain_profiles
+    def profile_page(self, hero):
+        return ('<html><body><div id="header"><img src="http://a.com/logo.png" /></div>'
+                '<div id="main"><figure class="hero"><img src="http://cdn.a.com/images/%s/photo.jpg" /></figure>'
+                '<img src="http://a.com/ad.gif" /></div></body></html>' % hero)
+
+    def test_domain_profiles_paths_and_patterns(self):
+        doc = lxml.html.document_fromstring(self.profile_page('2016'))
+        self.assertEquals(starimage.DomainProfiles.dom_path(doc.xpath('//img')[1]), 'body/div#main/figure.hero/img')
+        self.assertEquals(starimage.DomainProfiles.url_pattern('http://cdn.a.com/images/2016/photo.JPG?w=1'),
+                          'cdn.a.com/images/*/*.jpg')
+
+    def test_domain_profiles_predict_after_min_samples_when_confident(self):
+        profiles = starimage.DomainProfiles(min_samples=3, min_confidence=0.8)
+        for i in range(2):
+            profiles.record('a.com', 'body/img', 'a.com/*.jpg')
+        self.assertIsNone(profiles.predict('a.com'))
+        profiles.record('a.com', 'body/img', 'a.com/*.jpg')
+        self.assertEquals(profiles.predict('a.com'), {'path': 'body/img', 'pattern': 'a.com/*.jpg'})
+        profiles.record('a.com', 'body/div/img', 'a.com/*.jpg')
+        self.assertEquals(profiles.predict('a.com'), {'path': None, 'pattern': 'a.com/*.jpg'})
+        self.assertIsNone(profiles.predict('b.com'))
+
+    def test_domain_profiles_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'profiles.json')
+            profiles = starimage.DomainProfiles(path, min_samples=1)
+            profiles.record('a.com', 'body/img', 'a.com/*.jpg')
+            profiles.save()
+            self.assertEquals(starimage.DomainProfiles(path, min_samples=1).predict('a.com')['path'], 'body/img')
+        finally:
+            shutil.rmtree(directory)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_relearns_profile_when_winner_moves(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: \
+            900000 if 'big' in url else 5000 if 'photo' in url else 100
+        profiles = starimage.DomainProfiles(min_samples=2, check_every=2)
+        for year in ['2014', '2015']:
+            starimage.extract(self.profile_page(year), base_url='http://a.com', domain_profiles=profiles)
+        redesign = self.profile_page('2016').replace(
+            '</body>', '<section id="story"><img src="http://img.b.com/story/big.jpg" /></section></body>')
+        urls = [starimage.extract(redesign, base_url='http://a.com', domain_profiles=profiles)['url']
+                for i in range(4)]
+        self.assertEquals(urls, ['http://cdn.a.com/images/2016/photo.jpg'] + ['http://img.b.com/story/big.jpg'] * 3)
+        self.assertEquals(profiles.predict('a.com')['path'], 'body/section#story/img')
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_does_not_learn_from_predicted_images_only(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 90000 if 'photo' in url else 100
+        profiles = starimage.DomainProfiles(min_samples=1)
+        starimage.extract(self.profile_page('2014'), base_url='http://a.com', domain_profiles=profiles)
+        starimage.extract(self.profile_page('2015'), base_url='http://a.com', domain_profiles=profiles)
+        self.assertEquals(profiles.snapshot()['a.com']['samples'], 1)
+
+    def test_domain_profiles_save_without_path_raises_value_error(self):
+        self.assertRaises(ValueError, starimage.DomainProfiles().save)
+
+    @patch.object(starimage.StarImage, 'get_url_dimensions')
+    def test_extract_uses_prediction_by_area_without_size(self, get_url_dimensions_mock):
+        get_url_dimensions_mock.side_effect = lambda url, **kwargs: (800, 600, None) if 'photo' in url else (10, 10, None)
+        profiles = starimage.DomainProfiles(min_samples=1)
+        profiles.record('a.com', 'body/div#main/figure.hero/img', None)
+        stats = starimage.ExtractStats()
+        details = starimage.extract(self.profile_page('2016'), base_url='http://a.com', domain_profiles=profiles,
+                                    rank_by='area', stats=stats)
+        self.assertEquals(details['url'], 'http://cdn.a.com/images/2016/photo.jpg')
+        self.assertEquals(get_url_dimensions_mock.call_count, 1)
+        self.assertEquals(stats.as_dict()['profile_predictions'], 1)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_probes_only_predicted_image_once_learnt(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 90000 if 'photo' in url else 100
+        profiles = starimage.DomainProfiles(min_samples=2)
+        stats = starimage.ExtractStats()
+        for year in ['2014', '2015']:
+            starimage.extract(self.profile_page(year), base_url='http://a.com', domain_profiles=profiles)
+        self.assertEquals(get_url_content_length_mock.call_count, 6)
+        details = starimage.extract(self.profile_page('2016'), base_url='http://a.com', domain_profiles=profiles,
+                                    stats=stats)
+        self.assertEquals(details['url'], 'http://cdn.a.com/images/2016/photo.jpg')
+        self.assertEquals(details['probes_saved'], 2)
+        self.assertEquals(get_url_content_length_mock.call_count, 7)
+        self.assertEquals(stats.as_dict()['profile_predictions'], 1)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_falls_back_to_all_images_when_prediction_has_no_size(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 100 if 'ad' in url else 0
+        profiles = starimage.DomainProfiles(min_samples=1)
+        profiles.record('a.com', 'body/div#main/figure.hero/img', None)
+        stats = starimage.ExtractStats()
+        details = starimage.extract(self.profile_page('2016'), base_url='http://a.com', domain_profiles=profiles,
+                                    stats=stats)
+        self.assertEquals(details['url'], 'http://a.com/ad.gif')
+        self.assertEquals(details['probes_saved'], 0)
+        self.assertEquals(stats.as_dict()['profile_fallbacks'], 1)
+
+    # test extended_discovery
+    lazy_html = ('<html><body>'
+                 '<img src="data:image/gif;base64,R0lGOD" data-src="/lazy.jpg" width="300" height="200" />'
+                 '<img src="/small.jpg" srcset="/small.jpg 320w, /large.jpg 1280w, /medium.jpg 640w"'
+                 ' width="320" height="240" />'
+                 '<picture><source srcset="/hero.webp 1x, /hero@2x.webp 2x" type="image/webp" />'
+                 '<img src="/hero.jpg" width="600" height="400" /></picture>'
+                 '<div class="banner" style="color: red; background-image: url(\'/banner.png\')"></div>'
+                 '</body></html>')
+
+    def test_parse_srcset(self):
+        self.assertEquals(StarImage.parse_srcset('a.jpg 320w, b.jpg 2x,c.jpg'),
+                          [('a.jpg', 'w', 320.0), ('b.jpg', 'x', 2.0), ('c.jpg', 'x', 1.0)])
+        self.assertEquals(StarImage.parse_srcset('http://a.com/w_100,h_100/a.jpg 1.5x'),
+                          [('http://a.com/w_100,h_100/a.jpg', 'x', 1.5)])
+        self.assertEquals(StarImage.parse_srcset(None), [])
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_with_extended_discovery_probes_one_url_per_image(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        for streaming in [False, True]:
+            get_url_content_length_mock.reset_mock()
+            if streaming:
+                response = StringIO.StringIO(TestStarImage.lazy_html)
+                response.headers = {}
+                with patch('urllib2.urlopen', return_value=response):
+                    starimage.extract('http://a.com/page.html', streaming=True, extended_discovery=True)
+            else:
+                starimage.extract(TestStarImage.lazy_html, base_url='http://a.com', extended_discovery=True)
+            urls = sorted(call[0][0] for call in get_url_content_length_mock.call_args_list)
+            self.assertEquals(urls, ['http://a.com/banner.png', 'http://a.com/hero@2x.webp', 'http://a.com/large.jpg',
+                                     'http://a.com/lazy.jpg'])
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_with_extended_discovery_scales_declared_size_to_variant(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 90000 if url.endswith('large.jpg') else 100
+        details = starimage.extract(TestStarImage.lazy_html, base_url='http://a.com', extended_discovery=True)
+        self.assertEquals(details['url'], 'http://a.com/large.jpg')
+        self.assertEquals((details['width'], details['height']), (1280, 960))
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_without_extended_discovery_reads_only_img_src(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = 100
+        starimage.extract(TestStarImage.lazy_html, base_url='http://a.com')
+        urls = sorted(call[0][0] for call in get_url_content_length_mock.call_args_list)
+        self.assertEquals(urls, ['http://a.com/hero.jpg', 'http://a.com/small.jpg'])
+
+    # test timeout and deadline against a slow server
+    def test_extract_returns_result_when_probe_times_out(self):
+        slow_server = start_local_server(SlowHandler)
+        fast_server = start_local_server()
+        try:
+            slow_url = 'http://127.0.0.1:%d/slow.gif' % slow_server.server_port
+            fast_url = 'http://127.0.0.1:%d/fast.gif' % fast_server.server_port
+            html = '<html><body><img src="%s" /><img src="%s" /></body></html>' % (slow_url, fast_url)
+            details = starimage.extract(html, timeout=0.1, single_flight=False)
+            self.assertEquals((details['url'], details['size'], details['complete']), (fast_url, 123, True))
+            details = starimage.extract(html, deadline=0.2, single_flight=False)
+            self.assertEquals((details['url'], details['size'], details['complete']), (fast_url, 123, False))
+        finally:
+            for server in [slow_server, fast_server]:
+                server.shutdown()
+                server.server_close()
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_is_incomplete_when_probe_timeout_was_cut_by_deadline(self, get_url_content_length_mock):
+        def probe(url, timeout=None, **kwargs):
+            if 'slow' not in url:
+                return 100
+            time.sleep(timeout)
+            return starimage.ContentLength(0, error='timed out')
+        get_url_content_length_mock.side_effect = probe
+        html = '<html><body><img src="http://a.com/slow.gif" /><img src="http://a.com/fast.gif" /></body></html>'
+        for prioritize in [False, True] * 5:
+            details = starimage.extract(html, deadline=0.05, prioritize=prioritize, single_flight=False)
+            self.assertEquals((details['url'], details['complete']), ('http://a.com/fast.gif', False))
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_treats_probe_that_raised_as_no_size(self, get_url_content_length_mock):
+        def probe(url, **kwargs):
+            if url == 'http://a.com/1.gif':
+                raise ValueError('bad')
+            return 100
+        get_url_content_length_mock.side_effect = probe
+        html = '<html><body><img src="http://a.com/1.gif" /><img src="http://a.com/2.gif" /></body></html>'
+        self.assertEquals(starimage.extract(html)['url'], 'http://a.com/2.gif')
+        self.assertEquals(starimage.extract(html, prioritize=True)['url'], 'http://a.com/2.gif')
+        self.assertEquals([candidate.url for candidate in starimage.extract_ranked(html)], ['http://a.com/2.gif'])
+
+    # test ProbePool.submit(url, fn, *args, **kwargs)
+    def test_probe_pool_returns_results_in_submitted_order(self):
+        pool = starimage.ProbePool(max_workers=4, max_per_host=2)
+        futures = [pool.submit('http://a.com/%d.gif' % i, lambda n: n * 10, i) for i in range(10)]
+        self.assertEquals([future.result(1) for future in futures], [i * 10 for i in range(10)])
+
+    def test_probe_pool_limits_probes_per_host(self):
+        lock = threading.Lock()
+        counts = {'active': 0, 'peak': 0}
+        def probe():
+            with lock:
+                counts['active'] += 1
+                counts['peak'] = max(counts['peak'], counts['active'])
+            time.sleep(0.01)
+            with lock:
+                counts['active'] -= 1
+        pool = starimage.ProbePool(max_workers=8, max_per_host=2)
+        futures = [pool.submit('http://a.com/%d.gif' % i, probe) for i in range(6)]
+        for future in futures:
+            future.result(1)
+        self.assertEquals(counts['peak'], 2)
+
+    def test_probe_pool_raises_probe_exceptions_from_result(self):
+        pool = starimage.ProbePool()
+        future = pool.submit('http://a.com/1.gif', int, 'abc')
+        self.assertRaises(ValueError, future.result, 1)
+
+    # test ConnectionPool
+    def test_connection_pool_reuses_connections(self):
+        server = start_local_server()
+        try:
+            pool = starimage.ConnectionPool()
+            opener = urllib2.build_opener(pool)
+            url = 'http://127.0.0.1:%d' % server.server_port
+            self.assertEquals(starimage.StarImage.get_url_content_length(url + '/a.gif', opener), 123)
+            self.assertEquals(starimage.StarImage.get_url_content_length(url + '/b.gif', opener), 123)
+            self.assertEquals(opener.open(url + '/').read(), KeepAliveHandler.body)
+            self.assertEquals(starimage.StarImage.get_url_content_length(url + '/c.gif', opener), 123)
+            self.assertEquals(server.connections, 1)
+            self.assertEquals(pool.idle_count(), 1)
+            pool.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # test StarImage.extract_async(callback=None, page_pool=None)
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_async_returns_future_of_largest_image(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        self.star.url_or_html = TestStarImage.html
+        self.assertEquals(self.star.extract_async().result(1)['url'], 'http://a.com/2.gif')
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_async_calls_callback_with_future(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        done = threading.Event()
+        results = []
+        def callback(future):
+            results.append(future.result()['url'])
+            done.set()
+        starimage.extract_async(TestStarImage.html, callback=callback)
+        done.wait(1)
+        self.assertEquals(results, ['http://a.com/2.gif'])
+
+    def test_shared_probe_pool_has_two_workers_per_page_thread(self):
+        pool = starimage.shared_probe_pool
+        self.assertEquals(pool.workers.max_workers, starimage.shared_page_pool.max_workers * 2)
+        self.assertEquals(pool.max_per_host, starimage.DEFAULT_MAX_PER_HOST)
+
+    # test ProbeMemo.get(url, submit)
+    def test_probe_memo_submits_each_url_once(self):
+        memo = starimage.ProbeMemo()
+        submitted = []
+        def submit(url):
+            submitted.append(url)
+            return starimage.Future.completed(len(url))
+        self.assertEquals(memo.get('http://a.com/1.gif', submit).result(), 18)
+        self.assertEquals(memo.get('http://a.com/1.gif', submit).result(), 18)
+        self.assertEquals(submitted, ['http://a.com/1.gif'])
+        self.assertEquals((memo.hits, memo.misses), (1, 1))
+
+    # test MemoryCache and SqliteCache
+    def test_memory_cache_evicts_least_recently_used(self):
+        cache = starimage.MemoryCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEquals(cache.get('a').value, 1)
+        self.assertEquals(cache.stats()['evictions'], 1)
+
+    def test_memory_cache_returns_expired_entries_as_stale(self):
+        cache = starimage.MemoryCache(ttl=0)
+        cache.set('a', 1)
+        self.assertFalse(cache.get('a').fresh)
+        cache.ttl = 60
+        self.assertTrue(cache.get('a').fresh)
+        self.assertEquals((cache.hits, cache.stale, cache.misses), (1, 1, 0))
+
+    def test_sqlite_cache_survives_reopening(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'probes.db')
+            cache = starimage.SqliteCache(path, max_entries=2)
+            cache.set('a', {'size': 1})
+            cache.set('b', {'size': 2})
+            cache.set('c', {'size': 3})
+            cache.close()
+            cache = starimage.SqliteCache(path, max_entries=2)
+            self.assertEquals(len(cache), 2)
+            self.assertIsNone(cache.get('a'))
+            self.assertEquals(cache.get('c').value, {'size': 3})
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_uses_fresh_probe_cache_entries(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        cache = starimage.MemoryCache()
+        starimage.extract(TestStarImage.html, probe_cache=cache)
+        starimage.extract(TestStarImage.html, probe_cache=cache)
+        self.assertEquals(get_url_content_length_mock.call_count, 4)
+        self.assertEquals(cache.hits, 4)
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_revalidates_stale_probe_cache_entries(self, get_url_content_length_mock):
+        get_url_content_length_mock.return_value = starimage.ContentLength(0, not_modified=True)
+        cache = starimage.MemoryCache(ttl=0)
+        cache.set('http://a.com/1.gif', {'size': 700, 'etag': '"abc"', 'last_modified': None})
+        details = starimage.extract('<div><img src="http://a.com/1.gif" /></div>', probe_cache=cache)
+        self.assertEquals(details['size'], 700)
+        self.assertEquals(get_url_content_length_mock.call_args[1]['etag'], '"abc"')
+        self.assertEquals(cache.revalidated, 1)
+
+    # test extract_many(urls_or_html, base_url=None, max_pages=32, **options)
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_many_yields_result_for_each_page(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        pages = [TestStarImage.html, '<div><img src="http://a.com/3.gif" /></div>', '<div></div>']
+        results = dict(starimage.extract_many(pages, max_pages=2))
+        self.assertEquals(len(results), 3)
+        self.assertEquals(results[pages[0]]['url'], 'http://a.com/2.gif')
+        self.assertEquals(results[pages[1]]['url'], 'http://a.com/3.gif')
+        self.assertIsNone(results[pages[2]])
+
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_many_probes_shared_images_once(self, get_url_content_length_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        list(starimage.extract_many([TestStarImage.html] * 5))
+        self.assertEquals(get_url_content_length_mock.call_count, 4)
+
+    # test StarImage.__extract_streaming()
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_streaming_gets_largest_image(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        urlopen_mock.return_value = StringIO.StringIO(TestStarImage.html)
+        details = starimage.extract('http://a.com/page.html', streaming=True)
+        self.assertEquals(details['url'], 'http://a.com/2.gif')
+        self.assertEquals(details['width'], 100)
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_streaming_resolves_relative_images(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 900 if url == 'http://a.com/r2.gif' else 10
+        urlopen_mock.return_value = StringIO.StringIO(TestStarImage.html)
+        details = starimage.extract('http://a.com/page.html', streaming=True)
+        self.assertEquals(details['url'], 'http://a.com/r2.gif')
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_streaming_stops_after_max_stream_images(self, get_url_content_length_mock, urlopen_mock):
+        get_url_content_length_mock.side_effect = self.get_content_length
+        urlopen_mock.return_value = StringIO.StringIO(TestStarImage.html)
+        details = starimage.extract('http://a.com/page.html', base_url='http://b.com', streaming=True,
+                                    max_stream_images=4)
+        self.assertEquals(details['url'], 'http://a.com/1.gif')
+        self.assertEquals(get_url_content_length_mock.call_count, 4)
+
+    @patch('urllib2.urlopen')
+    @patch.object(starimage.StarImage, 'get_url_content_length')
+    def test_extract_streaming_keeps_max_probes_for_images_later_in_page(self, get_url_content_length_mock,
+                                                                         urlopen_mock):
+        get_url_content_length_mock.side_effect = lambda url, **kwargs: 90000 if 'hero' in url else 100
+        urlopen_mock.return_value = StringIO.StringIO(
+            '<html><body><img src="http://a.com/1.jpg" /><img src="http://a.com/2.jpg" />'
+            '<img src="http://a.com/3.jpg" /><img src="http://a.com/hero.jpg" width="800" height="600" />'
+            '</body></html>')
+        details = starimage.extract('http://a.com/page.html', streaming=True, max_probes=2)
+        self.assertEquals(details['url'], 'http://a.com/hero.jpg')
+        self.assertEquals(get_url_content_length_mock.call_count, 2)
+
     # test StarImage.extract(url_or_html, base_url=None)
     @patch.object(starimage.StarImage, 'get_url_content_length')
     def test_extract_gets_largest_image(self, get_url_content_length_mock):